@@ -0,0 +1,16 @@
+'''
+Headless analytics entry point
+
+Imports only numpy and the data/analysis half of base (no matplotlib, no
+data files read at import), for command line jobs where startup time
+matters. bench.py tracks how long this import takes.
+'''
+
+from base import TripTable, TripIndex, TripIntervalIndex, TripGraph,\
+	SystemSnapshot, SnapshotSeries, RebalancingIndex, RouteAggregates,\
+	read_data, read_all_data, iter_data, rebalancing_index,\
+	rebalancing_station_snapshot, parse_datetimes, dtfix, datefix,\
+	all_trips_from, all_trips_to, all_trips_by_bike_id, all_trips_by_city,\
+	weekday_split_trips, count_trips_by_start_hour, popular_stations,\
+	compile_all_routes, dwell_states, percentages_empty_full,\
+	stream_rebalancing_data
@@ -0,0 +1,101 @@
+'''
+System-wide animation of bike availability at every station
+
+The whole (frames x stations) availability matrix is computed up front
+from the RebalancingIndex, and each frame only recolors and resizes one
+scatter artist, so the animation can be blitted or rendered to a file.
+'''
+
+from base import *
+from matplotlib import animation
+
+class AvailabilityAnimation:
+	# Animated map of all stations (or those of one city) from start up to
+	#   end, one frame per step. Color shows how full a station is, using
+	#   color_gradient as a lookup table, and marker size its bike count.
+	def __init__(self, station_data, start, end, step=dt.timedelta(minutes=15),\
+		index=None, city=None, levels=20):
+		if index is None:
+			index = rebalancing_index()
+		step = np.timedelta64(step).astype('timedelta64[s]')
+		self.moments = np.arange(np.datetime64(start, 's'),
+		                         np.datetime64(end, 's'), step)
+		stations = [s for s in station_data if city is None or s.city == city]
+		self.station_ids = [int(s.id) for s in stations]
+		if city is None:
+			self.xy = np.array([[s.lon, s.lat] for s in stations])
+		else: # scaled city coordinates in meters
+			self.xy = np.array([s.loc for s in stations])
+		# (frames, stations) matrices
+		bikes = np.array([index.bikes_at(s, self.moments)
+		                  for s in self.station_ids]).T.reshape(len(self.moments), -1)
+		freedocks = np.array([index.freedocks_at(s, self.moments)
+		                      for s in self.station_ids]).T.reshape(bikes.shape)
+		known = (bikes >= 0) & (bikes + freedocks > 0)
+		fill = bikes / np.maximum(bikes + freedocks, 1).astype(float)
+		# last lookup table entry (gray) is for stations without data
+		self.colors = np.array(color_gradient(levels) + [(.7, .7, .7)])
+		self.color_index = np.where(known, np.rint(fill * (levels - 1)),
+		                            levels).astype(np.int16)
+		self.sizes = np.where(known, 10 + 6 * np.maximum(bikes, 0), 4)
+		self.figure = None
+		self.headless = False
+		return
+
+	def __len__(self):
+		return len(self.moments)
+
+	def setup(self, headless=False):
+		# Creates the figure and its artists; returns the artists to blit
+		# headless: plain Figure on an Agg canvas, which needs no display
+		#   (pyplot, and with it the GUI backend, is only used for show)
+		if headless:
+			from matplotlib.figure import Figure
+			from matplotlib.backends.backend_agg import FigureCanvasAgg
+			self.figure = Figure()
+			FigureCanvasAgg(self.figure)
+		else:
+			from matplotlib import pyplot as plt
+			self.figure = plt.figure()
+		self.headless = headless
+		ax = self.figure.add_subplot(111)
+		ax.set_aspect('equal')
+		ax.set_xticks([])
+		ax.set_yticks([])
+		margin = (self.xy.max(axis=0) - self.xy.min(axis=0)) * .05
+		ax.set_xlim(self.xy[:,0].min() - margin[0], self.xy[:,0].max() + margin[0])
+		ax.set_ylim(self.xy[:,1].min() - margin[1], self.xy[:,1].max() + margin[1])
+		self.scatter = ax.scatter(self.xy[:,0], self.xy[:,1], linewidths=0,
+		                          animated=True)
+		self.label = ax.text(.02, .95, '', transform=ax.transAxes,
+		                     animated=True)
+		return self.draw(0)
+
+	def draw(self, i):
+		# Updates the artists in place for frame i
+		self.scatter.set_facecolors(self.colors[self.color_index[i]])
+		self.scatter.set_sizes(self.sizes[i])
+		self.label.set_text(str(self.moments[i].astype(dt.datetime)))
+		return self.scatter, self.label
+
+	def animation(self, interval=50, headless=False):
+		# matplotlib FuncAnimation over all frames, with blitting
+		if self.figure is None or self.headless != headless:
+			self.setup(headless)
+		return animation.FuncAnimation(self.figure, self.draw,
+		                               frames=len(self), interval=interval,
+		                               init_func=lambda: self.draw(0),
+		                               blit=True)
+
+	def show(self):
+		from matplotlib import pyplot as plt
+		anim = self.animation()
+		plt.show()
+		return anim
+
+	def save(self, fname, fps=10, dpi=100):
+		# Renders every frame to a video (ffmpeg) or .gif (imagemagick)
+		#   file without opening a window
+		writer = 'imagemagick' if fname.endswith('.gif') else 'ffmpeg'
+		self.animation(headless=True).save(fname, writer=writer, fps=fps, dpi=dpi)
+		return
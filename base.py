@@ -4,16 +4,20 @@ Main modules for bikeshare data
 Dan Morris 3/28/14
 '''
 
-import simplejson as json
 import datetime as dt
+import itertools
+import os
 #from fun import *
 from constants import *
+from instrument import instrumented, length_of
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib import animation
+# matplotlib, multiprocessing and simplejson are imported by the functions
+#   that need them, to keep importing this module fast (see analytics.py)
 
 class Trip:
-	def __init__(self, trip_data_line):
+	def __init__(self, trip_data_line=None):
+		if trip_data_line is None:
+			return # empty Trip, filled in by TripTable.trip()
 		d = trip_data_line.split(",")
 		self.id = d[0]
 		self.duration = int(d[1]) # units: seconds
@@ -50,44 +54,353 @@ class Trip:
 		else:
 			return False
 
+class TripTable:
+	# Columnar store of trip data. Holds the same fields as Trip, one numpy
+	#   array per field, so filters can run as masks over the whole table.
+	#   Trip objects are only built on demand with trip(i) or by iterating.
+	columns = ['id', 'duration', 'start_moment', 'start_station',
+	           'start_terminal', 'end_moment', 'end_station', 'end_terminal',
+	           'bike_id', 'sub_type', 'zipcode', 'city', 'weekday']
+
+	def __init__(self, sub_types=(), **cols):
+		# cols: one array per name in TripTable.columns
+		# sub_types: category names indexed by the sub_type codes
+		self.sub_types = list(sub_types)
+		for c in self.columns:
+			setattr(self, c, cols[c])
+		self.trip_index = None
+		return
+
+	@classmethod
+	def from_lines(cls, lines):
+		# Parses raw trip data lines (no header) into a TripTable
+		d = [l.rstrip('\r\n').split(',') for l in lines]
+		d = zip(*d) if d else [()] * 11
+		start_station = station_codes(d[3])
+		sub_types, sub_type = np.unique(np.array(d[9], dtype=str),
+		                                return_inverse=True)
+		start_moment = parse_datetimes(d[2])
+		return cls(sub_types = sub_types,
+		           id = parse_ints(d[0]).astype(np.int32),
+		           duration = parse_ints(d[1]).astype(np.int32),
+		           start_moment = start_moment,
+		           start_station = start_station,
+		           start_terminal = parse_ints(d[4]).astype(np.int16),
+		           end_moment = parse_datetimes(d[5]),
+		           end_station = station_codes(d[6]),
+		           end_terminal = parse_ints(d[7]).astype(np.int16),
+		           bike_id = parse_ints(d[8]).astype(np.int32),
+		           sub_type = sub_type.astype(np.int8),
+		           zipcode = np.array(d[10], dtype=str),
+		           city = station_city_codes(start_station),
+		           weekday = weekdays(start_moment))
+
+	@classmethod
+	def concatenate(cls, tables):
+		# Joins a list of TripTables end to end into a single table
+		sub_types = []
+		for t in tables:
+			sub_types += [s for s in t.sub_types if s not in sub_types]
+		cols = {}
+		for c in cls.columns:
+			if c == 'sub_type':
+				codes = [np.array([sub_types.index(s) for s in t.sub_types],
+				                  dtype=np.int8)[t.sub_type] for t in tables]
+				cols[c] = np.concatenate(codes) if codes else \
+				          np.zeros(0, dtype=np.int8)
+			else:
+				cols[c] = np.concatenate([getattr(t, c) for t in tables])
+		return cls(sub_types = sub_types, **cols)
+
+	def as_columns(self):
+		# Dict of all column arrays, TripTable(**cols) rebuilds the table
+		cols = {'sub_types': np.array(self.sub_types, dtype=str)}
+		for c in self.columns:
+			cols[c] = getattr(self, c)
+		return cols
+
+	def __len__(self):
+		return len(self.id)
+
+	def __getitem__(self, key):
+		# An integer returns a Trip, anything else (slice, mask, index array)
+		#   returns a new TripTable with the selected rows
+		if isinstance(key, (int, long, np.integer)):
+			return self.trip(key)
+		cols = {}
+		for c in self.columns:
+			cols[c] = getattr(self, c)[key]
+		return TripTable(sub_types = self.sub_types, **cols)
+
+	def __iter__(self):
+		for i in xrange(len(self)):
+			yield self.trip(i)
+
+	def trip(self, i):
+		# Builds a Trip object for row i
+		t = Trip()
+		t.id = str(self.id[i])
+		t.duration = int(self.duration[i])
+		t.start_moment = self.start_moment[i].astype(dt.datetime)
+		t.start_station = str(self.start_station[i])
+		t.start_terminal = str(self.start_terminal[i])
+		t.end_moment = self.end_moment[i].astype(dt.datetime)
+		t.end_station = str(self.end_station[i])
+		t.end_terminal = str(self.end_terminal[i])
+		t.bike_id = str(self.bike_id[i])
+		t.sub_type = self.sub_types[self.sub_type[i]]
+		t.zipcode = self.zipcode[i]
+		c = self.city[i]
+		t.city = city_names[c] if c >= 0 else None
+		t.weekday = int(self.weekday[i])
+		t.route = t.start_station+','+t.end_station
+		return t
+
+	def sub_type_code(self, sub_type):
+		# Returns the integer code of a subscriber type, -1 if not present
+		if sub_type in self.sub_types:
+			return list(self.sub_types).index(sub_type)
+		return -1
+
+	def start_hours(self):
+		# Hour of day (0-23) each trip starts
+		m = self.start_moment
+		h = (m - m.astype('datetime64[D]')).astype('timedelta64[h]')
+		return h.astype(np.int8)
+
+	def index(self):
+		# TripIndex over this table, built on first use
+		if self.trip_index is None:
+			self.trip_index = TripIndex(self)
+		return self.trip_index
+
+class TripIndex:
+	# Secondary indexes over a TripTable. For each key the trip positions
+	#   are sorted by key value (stably, so positions stay sorted within a
+	#   value), which gives every value's trips as one sorted slice.
+	#   Queries on several keys take the smallest of those sets and keep
+	#   the trips whose other key columns match.
+	keys = ['start_station', 'end_station', 'bike_id', 'city', 'weekday',
+	        'start_hour', 'sub_type']
+
+	def __init__(self, trip_table):
+		self.trips = trip_table
+		self.groups = {} # key: (sorted values, trip positions)
+		self.columns = {} # key: value per trip
+		for k in self.keys:
+			if k == 'start_hour':
+				col = trip_table.start_hours()
+			else:
+				col = getattr(trip_table, k)
+			order = np.argsort(col, kind='mergesort').astype(np.int32)
+			self.groups[k] = (col[order], order)
+			self.columns[k] = col
+		return
+
+	def code(self, key, value):
+		# Converts a query value into the integer stored for key
+		if key == 'city':
+			return city_names.index(value) if value in city_names else -2
+		if key == 'sub_type':
+			return self.trips.sub_type_code(value)
+		return int(value)
+
+	def positions(self, key, value):
+		# Sorted positions of the trips where key == value. value can also
+		#   be a list (or range) of values, matching any of them.
+		order = self.groups[key][1]
+		lo, hi = self.bounds(key, value)
+		if len(lo) == 1:
+			return order[lo[0]:hi[0]]
+		found = [order[l:h] for l, h in zip(lo, hi)]
+		if not found:
+			return np.zeros(0, dtype=np.int32)
+		return np.sort(np.concatenate(found))
+
+	def codes(self, key, value):
+		# Integer codes of a query value or list of values, in the dtype of
+		#   the key's column (codes it cannot hold match nothing and are
+		#   dropped), so searches do not convert the column
+		if not isinstance(value, (list, tuple, set, xrange)):
+			value = [value]
+		dtype = self.columns[key].dtype
+		info = np.iinfo(dtype)
+		c = [self.code(key, v) for v in value]
+		return np.array([x for x in c if info.min <= x <= info.max], dtype=dtype)
+
+	def bounds(self, key, value):
+		# Start and end of each value's slice of the key's sorted positions
+		values = self.groups[key][0]
+		c = self.codes(key, value)
+		return (np.searchsorted(values, c, side='left'),
+		        np.searchsorted(values, c, side='right'))
+
+	def count(self, key, value):
+		# Number of trips where key == value (or any of a list of values)
+		lo, hi = self.bounds(key, value)
+		return int((hi - lo).sum())
+
+	def select(self, **criteria):
+		# Sorted positions of the trips matching all criteria, e.g.
+		#   select(start_station='70', weekday=[5,6], start_hour=range(7,9))
+		if not criteria:
+			return np.arange(len(self.trips), dtype=np.int32)
+		smallest = min(criteria, key=lambda k: self.count(k, criteria[k]))
+		result = self.positions(smallest, criteria[smallest])
+		for k in criteria:
+			if k != smallest and len(result):
+				column = self.columns[k][result]
+				result = result[np.in1d(column, self.codes(k, criteria[k]))]
+		return result
+
+	def query(self, **criteria):
+		# The matching trips as a TripTable (see select)
+		return self.trips[self.select(**criteria)]
+
+class TripIntervalIndex:
+	# Index over the (start_moment, end_moment) interval of every trip.
+	#   Trips are split into duration classes [2^k, 2^(k+1)) seconds, each
+	#   sorted by start, so the trips active at t in a class all start in a
+	#   window no longer than the class's maximum duration. Queries cost
+	#   O(classes * log(trips)) plus the size of the answer.
+	def __init__(self, trip_data):
+		self.trip_data = trip_data
+		if is_table(trip_data):
+			starts = trip_data.start_moment
+			ends = trip_data.end_moment
+		else:
+			starts = np.array([t.start_moment for t in trip_data],
+			                  dtype='datetime64[s]')
+			ends = np.array([t.end_moment for t in trip_data],
+			                dtype='datetime64[s]')
+		starts = starts.astype(np.int64)
+		ends = ends.astype(np.int64)
+		durations = ends - starts
+		valid = np.flatnonzero(durations > 0) # never active otherwise
+		k = np.log2(durations[valid]).astype(np.int64)
+		self.classes = [] # (max duration, starts, ends, trip positions)
+		for c in np.unique(k):
+			pos = valid[k == c]
+			pos = pos[np.argsort(starts[pos], kind='mergesort')]
+			self.classes.append((2 ** (c + 1), starts[pos], ends[pos], pos))
+		return
+
+	def active_between(self, t0, t1):
+		# Sorted positions of the trips active at some point in [t0, t1)
+		t0 = np.datetime64(t0, 's').astype(np.int64)
+		t1 = np.datetime64(t1, 's').astype(np.int64)
+		found = [np.zeros(0, dtype=np.int64)]
+		for maxdur, starts, ends, pos in self.classes:
+			lo = np.searchsorted(starts, t0 - maxdur, side='right')
+			hi = np.searchsorted(starts, t1, side='left')
+			found.append(pos[lo:hi][ends[lo:hi] > t0])
+		return np.sort(np.concatenate(found))
+
+	def active_at(self, t):
+		# Sorted positions of the trips active at t (see Trip.active_during)
+		return self.active_between(t, np.datetime64(t, 's') + 1)
+
+	def count_active(self, t0, t1=None):
+		# Number of trips active at t0, or during [t0, t1)
+		if t1 is None:
+			return len(self.active_at(t0))
+		return len(self.active_between(t0, t1))
+
+	def active_counts(self, t, by='route'):
+		# Dict of active trip counts at t grouped by a Trip attribute,
+		#   e.g. 'route' (keyed 'start,end') or 'bike_id'
+		i = self.active_at(t)
+		counts = {}
+		if not is_table(self.trip_data):
+			for p in i:
+				k = getattr(self.trip_data[p], by)
+				counts[k] = counts.get(k, 0) + 1
+			return counts
+		if by == 'route': # codes of the active trips only, not the table
+			t = self.trip_data
+			codes = t.start_station[i].astype(np.int64) * 65536 \
+			        + t.end_station[i]
+		else:
+			codes = getattr(self.trip_data, by)[i]
+		keys, n = np.unique(codes, return_counts=True)
+		for k, c in zip(keys, n):
+			counts[route_name(k) if by == 'route' else str(k)] = int(c)
+		return counts
+
 class TripGraph:
+	# Stations and routes of a list or TripTable of trips. Station ids are
+	#   mapped to dense node numbers (node_index), and the trips on each
+	#   edge are stored as positions into trip_list, grouped by edge in one
+	#   array with per-edge offsets.
+	@instrumented('TripGraph', length_of('trip_list', 1))
 	def __init__(self, trip_list):
-		self.nodes = [] # station ids
-		self.edges = {} # keyed by 'start,end' string
-		for t in trip_list:
-			s = t.start_station
-			e = t.end_station
-			# Add station if new
-			if s not in self.nodes:
-				self.nodes.append(s)
-			if e not in self.nodes:
-				self.nodes.append(e)
-			# Load edges dict with lists of trips on each edge
-			k = s+","+e
-			if k in self.edges:
-				self.edges[k].append(t)
-			else:
-				self.edges[k] = [t]
+		self.trips = trip_list
+		self.interval_index = None
+		if is_table(trip_list):
+			starts = trip_list.start_station.astype(np.int64)
+			ends = trip_list.end_station.astype(np.int64)
+		else:
+			starts = np.array([int(t.start_station) for t in trip_list],
+			                  dtype=np.int64)
+			ends = np.array([int(t.end_station) for t in trip_list],
+			                dtype=np.int64)
+		ids, codes = np.unique(np.concatenate([starts, ends]),
+		                       return_inverse=True)
+		n = len(ids)
+		m = len(starts)
+		self.nodes = [str(i) for i in ids] # station ids
+		self.node_index = dict((s, i) for i, s in enumerate(self.nodes))
+		edge = codes[:m] * n + codes[m:] # start node * n + end node
+		# trip positions grouped by edge, edges in edge code order
+		self.trip_order = np.argsort(edge, kind='mergesort')
+		self.edge_codes, first = np.unique(edge[self.trip_order],
+		                                   return_index=True)
+		self.edge_offsets = np.append(first, m)
+		self.trip_edge = np.searchsorted(self.edge_codes, edge)
+		self.edge_keys = [self.nodes[c // n]+","+self.nodes[c % n]
+		                  for c in self.edge_codes]
+		self.edges = {} # keyed by 'start,end' string, trip positions
+		for j in xrange(len(self.edge_keys)):
+			o = self.edge_offsets
+			self.edges[self.edge_keys[j]] = self.trip_order[o[j]:o[j+1]]
+		self.weights = np.bincount(edge, minlength=n*n).reshape(n, n)
 		return
 
+	def weight_matrix(self):
+		# (nodes x nodes) array of trip counts, rows are start stations
+		return self.weights
+
+	def trips_on(self, key):
+		# The trips on edge 'start,end', as a TripTable or list of Trips
+		i = self.edges.get(key, np.zeros(0, dtype=np.int64))
+		if is_table(self.trips):
+			return self.trips[i]
+		return [self.trips[p] for p in i]
+
+	def intervals(self):
+		# TripIntervalIndex over this graph's trips, built on first use
+		if self.interval_index is None:
+			self.interval_index = TripIntervalIndex(self.trips)
+		return self.interval_index
+
 class SystemSnapshot:
 	# A simplified look at the whole system at a given moment in time
 	#   designed to be easily portable in JSON or csv.
-	def __init__(self, tripgraph, moment):
+	@instrumented('SystemSnapshot')
+	def __init__(self, tripgraph, moment, nodes=None, edges=None):
+		# nodes, edges: precomputed values (see SnapshotSeries)
 		self.moment = moment
+		if nodes is not None and edges is not None:
+			self.nodes = nodes
+			self.edges = edges
+			return
 		# Load nodes
 		self.nodes = {} # key: station, value: # available bikes
 		for n in tripgraph.nodes:
 			self.nodes[n] = rebalancing_station_snapshot(n, moment)
 		# Load edges
-		self.edges = {} # key: 'start,end', value: # of active trips
-		for k in tripgraph.edges:
-			for t in tripgraph.edges[k]:
-				if t.active_during(moment):
-					if k in self.edges:
-						self.edges[k] += 1
-					else:
-						self.edges[k] = 1
+		# key: 'start,end', value: # of active trips
+		self.edges = tripgraph.intervals().active_counts(moment, 'route')
 		return
 
 	''' - currently unnecessary, no empty edges are created
@@ -100,13 +413,61 @@ class SystemSnapshot:
 			del self.edges[d]
 		return'''
 
+	@instrumented('SystemSnapshot.output_json')
 	def output_json(self):
-		fname = snap_filename(self.moment, 'json')
+		# Writes the snapshot as one compact JSON document (see frame)
+		fname = snap_filename(self.moment, 'snapshot', 'json')
+		stations = self.station_list()
+		doc = self.frame(stations)
+		doc['stations'] = np.array(stations, dtype=np.int64)
 		with open(fname, 'w') as f:
-			json.dump(self.nodes, f, indent=0)
-			json.dump(self.edges, f, indent=0)
+			f.write(compact_json(doc))
 		return
 
+	def station_list(self):
+		# Integer ids of the snapshot's stations, the order frame() uses
+		return sorted(int(n) for n in self.nodes)
+
+	def frame(self, stations, previous=None):
+		# The snapshot as a dict of integer arrays, stations given by their
+		#   position in the stations list:
+		#   moment: ISO date and time
+		#   bikes: available bikes per station (-1: no data)
+		#   edges: flat [start, end, active trips, start, end, ...] triples
+		# With previous (the prior SystemSnapshot) only changes are kept:
+		#   bikes becomes flat [station, bikes, ...] pairs for the stations
+		#   that changed, edges lists changed edges (0 trips for edges no
+		#   longer active), and delta is 1.
+		bikes, edges = self.frame_arrays(stations)
+		doc = {'moment': self.moment.isoformat()}
+		if previous is not None:
+			old_bikes, old_edges = previous.frame_arrays(stations)
+			changed = np.flatnonzero(bikes != old_bikes)
+			bikes = np.column_stack([changed, bikes[changed]]).ravel()
+			edges = dict((k, edges.get(k, 0))
+			             for k in set(old_edges) | set(edges)
+			             if edges.get(k, 0) != old_edges.get(k, 0))
+			doc['delta'] = 1
+		flat = [x for k in sorted(edges) for x in (k[0], k[1], edges[k])]
+		doc['bikes'] = bikes
+		doc['edges'] = np.array(flat, dtype=np.int64)
+		return doc
+
+	def frame_arrays(self, stations):
+		# Bikes per station position (-1: no data) and a dict of active
+		#   trips keyed by (start position, end position)
+		position = dict((str(s), i) for i, s in enumerate(stations))
+		bikes = np.zeros(len(stations), dtype=np.int64) - 1
+		for n in self.nodes:
+			if self.nodes[n] is not None and n in position:
+				bikes[position[n]] = self.nodes[n]
+		edges = {}
+		for e in self.edges:
+			s, t = e.split(',')
+			edges[(position[s], position[t])] = self.edges[e]
+		return bikes, edges
+
+	@instrumented('SystemSnapshot.output_csvs')
 	def output_csvs(self):
 		# Writes csvs to file with visualization purposes in mind
 		nodes_filename = snap_filename(self.moment, 'nodes', 'csv')
@@ -136,6 +497,68 @@ class SystemSnapshot:
 				+e[0]+" to station "+e[1]+"\n"
 		return s
 
+class SnapshotSeries:
+	# SystemSnapshots for every moment from start up to (not including) end,
+	#   one per step. Trip start and end times are sorted once and swept
+	#   forward, keeping the active trip count of every edge up to date, so
+	#   the cost is O(trips + frames) rather than O(trips * frames).
+	def __init__(self, tripgraph, start, end, step=dt.timedelta(minutes=15)):
+		self.tripgraph = tripgraph
+		step = np.timedelta64(step).astype('timedelta64[s]')
+		self.moments = np.arange(np.datetime64(start, 's'),
+		                         np.datetime64(end, 's'), step)
+		return
+
+	def __len__(self):
+		return len(self.moments)
+
+	def node_series(self):
+		# Dict of station: array of available bikes at every moment
+		#   (-1 before the station had a reading)
+		index = rebalancing_index()
+		nodes = {}
+		for n in self.tripgraph.nodes:
+			nodes[n] = index.bikes_at(n, self.moments)
+		return nodes
+
+	def __iter__(self):
+		keys, edge, starts, ends = edge_intervals(self.tripgraph)
+		so = np.argsort(starts, kind='mergesort')
+		eo = np.argsort(ends, kind='mergesort')
+		start_edges, end_edges = edge[so], edge[eo]
+		# trips started at or before each moment, and ended at or before it
+		sp = np.searchsorted(starts[so], self.moments, side='right')
+		ep = np.searchsorted(ends[eo], self.moments, side='right')
+		counts = np.zeros(len(keys), dtype=np.int64)
+		node_series = self.node_series()
+		si = ei = 0
+		for f in xrange(len(self.moments)):
+			counts += np.bincount(start_edges[si:sp[f]], minlength=len(keys))
+			counts -= np.bincount(end_edges[ei:ep[f]], minlength=len(keys))
+			si, ei = sp[f], ep[f]
+			edges = {}
+			for k in np.flatnonzero(counts):
+				edges[keys[k]] = int(counts[k])
+			nodes = {}
+			for n in node_series:
+				b = node_series[n][f]
+				nodes[n] = int(b) if b >= 0 else None
+			moment = self.moments[f].astype(dt.datetime)
+			yield SystemSnapshot(self.tripgraph, moment, nodes, edges)
+
+def edge_intervals(tripgraph):
+	# Flattens the trips of a TripGraph into arrays for SnapshotSeries:
+	#   edge keys, and per trip its edge number, start and end moments
+	trips = tripgraph.trips
+	if is_table(trips):
+		starts = trips.start_moment
+		ends = trips.end_moment
+	else:
+		starts = np.array([t.start_moment for t in trips],
+		                  dtype='datetime64[s]')
+		ends = np.array([t.end_moment for t in trips], dtype='datetime64[s]')
+	return tripgraph.edge_keys, tripgraph.trip_edge, starts, ends
+
 class Station:
 	def __init__(self, station_data_line):
 		d = station_data_line.split(',')
@@ -157,64 +580,347 @@ class Station:
 		return (x,y)
 
 class Rebalancing:
-	def __init__(self, rebalancing_data_line):
+	def __init__(self, rebalancing_data_line, moment=None):
+		# moment: already parsed datetime, skips dtfix (see read_data)
 		d = rebalancing_data_line.split(',')
 		self.id = d[0]
 		self.bikes = int(d[1])
 		self.freedocks = int(d[2])
 		self.docks = self.bikes + self.freedocks
-		moment = d[3].strip('\n')
-		self.datetime = dtfix(moment)
+		if moment is None:
+			moment = dtfix(d[3].strip('\n'))
+		self.datetime = moment
+
+class RebalancingIndex:
+	# Rebalancing time series for every station as sorted numpy arrays
+	#   (station, time, bikes, freedocks), saved as .npy files and memory
+	#   mapped. Rows for station s are offsets[s]:offsets[s+1], sorted by
+	#   time, so a lookup is a binary search within one station's rows.
+	arrays = ['station', 'time', 'bikes', 'freedocks', 'offsets']
+
+	def __init__(self, path, mmap_mode='r'):
+		# path: directory written by RebalancingIndex.build
+		self.path = path
+		for a in self.arrays:
+			fname = os.path.join(path, a + '.npy')
+			setattr(self, a, np.load(fname, mmap_mode=mmap_mode))
+		return
+
+	@classmethod
+	@instrumented('RebalancingIndex.build',\
+		lambda result, *args, **kwargs: len(result.time))
+	def build(cls, path, filename=data_file_names["rebalancing"]):
+		# Parses a rebalancing data file and writes the index to path
+		with open(filename) as f:
+			f.readline() # clear header
+			d = zip(*[l.split(',') for l in f if l.strip()])
+		station, time, bikes, freedocks = rebalancing_columns(d)
+		return cls.write(path, station, time, bikes, freedocks,
+		                 source_stamp(filename))
+
+	@classmethod
+	def write(cls, path, station, time, bikes, freedocks, stamp):
+		# Sorts readings (arrays in any order) and writes the index to path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		order = np.lexsort((time, station))
+		arrays = {'station': station[order], 'time': time[order],
+		          'bikes': bikes[order], 'freedocks': freedocks[order]}
+		n = int(station.max()) + 2 if len(station) else 1
+		arrays['offsets'] = np.searchsorted(arrays['station'], np.arange(n))
+		arrays['source_stamp'] = stamp
+		for a in arrays:
+			np.save(os.path.join(path, a + '.npy'), arrays[a])
+		return cls(path)
+
+	def is_current(self, filename=data_file_names["rebalancing"]):
+		# False if the data file changed after the index was built
+		stamp = np.load(os.path.join(self.path, 'source_stamp.npy'))
+		return np.array_equal(stamp, source_stamp(filename))
+
+	def rows(self, station):
+		# Slice of the rows for one station
+		s = int(station)
+		if s < 0 or s + 1 >= len(self.offsets):
+			return slice(0, 0)
+		return slice(self.offsets[s], self.offsets[s+1])
+
+	def lookup(self, station, moments):
+		# Row positions of the latest reading at or before each moment
+		#   for one station, -1 where the station had no reading yet
+		r = self.rows(station)
+		moments = np.asarray(moments, dtype='datetime64[s]')
+		i = np.searchsorted(self.time[r], moments, side='right') - 1
+		return np.where(i >= 0, i + r.start, -1)
+
+	def value_at(self, column, station, moments):
+		# Value of column ('bikes' or 'freedocks') at station for a datetime
+		#   or an array of them, -1 where the station had no reading yet
+		i = self.lookup(station, moments)
+		values = getattr(self, column)
+		if len(values) == 0:
+			return np.zeros(np.shape(i), dtype=np.int16) - 1
+		return np.where(i >= 0, values[i], -1)
+
+	def bikes_at(self, station, moments):
+		return self.value_at('bikes', station, moments)
+
+	def freedocks_at(self, station, moments):
+		return self.value_at('freedocks', station, moments)
+
+	def stations(self):
+		# Integer ids of all stations in the index
+		return np.flatnonzero(np.diff(self.offsets) > 0)
+
+	def snapshot(self, moment):
+		# (station ids, bikes, freedocks) arrays for every station at
+		#   moment, -1 for stations without a reading yet
+		stations = self.stations()
+		i = np.array([self.lookup(s, moment) for s in stations],
+		             dtype=np.int64)
+		bikes = np.where(i >= 0, self.bikes[np.maximum(i, 0)], -1)
+		freedocks = np.where(i >= 0, self.freedocks[np.maximum(i, 0)], -1)
+		return stations, bikes, freedocks
+
+def rebalancing_columns(d):
+	# (station, time, bikes, freedocks) arrays from the split fields of
+	#   rebalancing data lines, transposed (d[0]: station ids, ...)
+	if not d:
+		empty = np.zeros(0, dtype=np.int16)
+		return empty, parse_datetimes([]), empty, empty
+	return (parse_ints(d[0]).astype(np.int16), parse_datetimes(d[3]),
+	        parse_ints(d[1]).astype(np.int16), parse_ints(d[2]).astype(np.int16))
+
+rebalancing_index_path = "datafiles/rebalancing_index"
+loaded_rebalancing_index = []
+
+def rebalancing_index(path=rebalancing_index_path):
+	# Returns the RebalancingIndex for the rebalancing data file, building
+	#   it if it is missing or out of date. Loaded once per process.
+	if loaded_rebalancing_index:
+		return loaded_rebalancing_index[0]
+	index = None
+	if os.path.exists(os.path.join(path, 'offsets.npy')):
+		index = RebalancingIndex(path)
+		if not index.is_current():
+			index = None
+	if index is None:
+		index = RebalancingIndex.build(path)
+	loaded_rebalancing_index.append(index)
+	return index
 
 '''
 class Weather:
 	def __init__(self, weather_data):
 '''
 
-def read_data(type, n="all"):
+def count_rows(result, *args, **kwargs):
+	# rows processed by an instrumented call that returns its rows
+	return len(result) if result is not None else 0
+
+@instrumented('read_data', count_rows)
+def read_data(type, n="all", cache=False, workers=1):
 	# Reads the first n data lines from filename
+	# cache: with n="all", load the parsed file from its binary cache if the
+	#   cache is up to date, otherwise parse it and write the cache
+	# workers: with n="all", parse trip data in this many processes
 	if type not in data_file_names.keys():
 		print "bad type!"
 		return None
 	filename = data_file_names[type]
-	datalist = []
+	cols = None
 	if n == "all":
-		n = data_file_lengths[type] - 1
-	with open(filename) as f:
+		n = None # read to end of file
+		if cache:
+			cols = read_cache(filename)
+		if cols is None and type == "trip" and workers > 1:
+			cols = read_trips_parallel(filename, workers).as_columns()
+			if cache:
+				write_cache(filename, cols)
+	if cols is None:
+		with open(filename) as f:
+			f.readline() # Clear header
+			lines = [l for l in itertools.islice(f, n) if l.strip()]
+		cols = parse_columns(type, lines)
+		if cache and n is None:
+			write_cache(filename, cols)
+	return build_data(type, cols)
+
+def iter_data(type, batch_size=10000, tables=False, since=None, until=None,\
+	stations=None):
+	# Reads a data file lazily, batch_size lines at a time, until end of file.
+	#   Yields one object per matching line, or with tables=True (trip data
+	#   only) one TripTable per batch. Filters are applied to the parsed
+	#   columns, so lines that do not match never become objects:
+	# since, until: keep trips starting / readings taken in [since, until)
+	# stations: keep trips starting at / readings from these station ids
+	#   (filters only apply to trip and rebalancing data, ValueError
+	#   otherwise)
+	if type not in data_file_names.keys():
+		print "bad type!"
+		return
+	filtered = since is not None or until is not None or stations is not None
+	if filtered and type not in ("trip", "rebalancing"):
+		raise ValueError("since, until and stations only filter trip and "
+		                 "rebalancing data, not " + type)
+	with open(data_file_names[type]) as f:
 		f.readline() # Clear header
-		if type == "trip":
-			for i in xrange(n):
-				d = f.readline()
-				datalist.append(Trip(d))
-		elif type == "station":
-			for i in xrange(n):
-				d = f.readline()
-				datalist.append(Station(d))
-		elif type == "weather":
-			for i in xrange(n):
-				d = f.readline()
-				datalist.append(Weather(d))
-		elif type == "rebalancing":
-			for i in xrange(n):
-				d = f.readline()
-				datalist.append(Rebalancing(d))
+		while True:
+			lines = [l for l in itertools.islice(f, batch_size) if l.strip()]
+			if not lines:
+				break
+			for item in filter_batch(type, lines, tables, since, until,
+			                         stations):
+				yield item
+
+def filter_batch(type, lines, tables, since, until, stations):
+	# Parses one iter_data batch and returns its matching items
+	if type == "trip":
+		batch = TripTable.from_lines(lines)
+		keep = moment_mask(batch.start_moment, since, until) & \
+		       station_mask(batch.start_station, stations)
+		batch = batch[keep]
+		return [batch] if tables else batch
+	if type != "rebalancing":
+		return build_data(type, {'line': np.array(lines, dtype=str)})
+	cols = parse_columns(type, lines)
+	ids = parse_ints([l.split(',', 1)[0] for l in lines])
+	keep = moment_mask(cols['moment'], since, until) & \
+	       station_mask(ids, stations)
+	return build_data(type, {'line': cols['line'][keep],
+	                         'moment': cols['moment'][keep]})
+
+def moment_mask(moments, since, until):
+	# Boolean mask of moments in [since, until), either bound may be None
+	keep = np.ones(len(moments), dtype=bool)
+	if since is not None:
+		keep &= moments >= np.datetime64(since, 's')
+	if until is not None:
+		keep &= moments < np.datetime64(until, 's')
+	return keep
+
+def station_mask(station_ids, stations):
+	# Boolean mask of station_ids in stations (all True if stations is None)
+	if stations is None:
+		return np.ones(len(station_ids), dtype=bool)
+	return np.in1d(station_ids, [int(s) for s in stations])
+
+def trip_batches(trip_data):
+	# Iterates a TripTable as a single batch, and anything else (list of
+	#   Trips, iter_data stream of Trips or TripTables) item by item
+	if is_table(trip_data):
+		return [trip_data]
+	return trip_data
+
+def read_trips_parallel(filename, workers):
+	# Parses a trip data file into a TripTable with a pool of worker
+	#   processes, each parsing a newline aligned byte range of the file
+	ranges = byte_ranges(filename, workers * 4)
+	import multiprocessing
+	pool = multiprocessing.Pool(workers)
+	try:
+		tables = pool.map(parse_trip_chunk, [(filename, s, e) for s, e in ranges])
+	finally:
+		pool.close()
+		pool.join()
+	return TripTable.concatenate([TripTable(**c) for c in tables])
+
+def byte_ranges(filename, parts):
+	# Splits the data lines of a file (after the header) into about parts
+	#   (start, end) byte ranges that begin and end on line boundaries
+	size = os.path.getsize(filename)
+	with open(filename, 'rb') as f:
+		f.readline() # skip header
+		bounds = [f.tell()]
+		first = bounds[0]
+		for i in range(1, parts):
+			f.seek(max(first + (size - first) * i // parts, bounds[-1]))
+			f.readline() # move to the start of the next line
+			bounds.append(min(f.tell(), size))
+	bounds.append(size)
+	return [(s, e) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+def parse_trip_chunk(args):
+	# Worker for read_trips_parallel: parses one byte range of a trip file
+	#   into TripTable columns
+	filename, start, end = args
+	with open(filename, 'rb') as f:
+		f.seek(start)
+		lines = [l for l in f.read(end - start).splitlines() if l.strip()]
+	return TripTable.from_lines(lines).as_columns()
+
+@instrumented('parse_columns', length_of('lines', 1))
+def parse_columns(type, lines):
+	# Parses raw data lines into a dict of numpy arrays (see build_data)
+	if type == "trip":
+		return TripTable.from_lines(lines).as_columns()
+	cols = {'line': np.array(lines, dtype=str)}
+	if type == "rebalancing":
+		cols['moment'] = parse_datetimes([l.split(',')[3] for l in lines])
+	return cols
+
+def build_data(type, cols):
+	# Turns the arrays from parse_columns back into the read_data result
+	if type == "trip":
+		return TripTable(**cols)
+	datalist = []
+	lines = cols['line']
+	if type == "station":
+		for d in lines:
+			datalist.append(Station(d))
+	elif type == "weather":
+		for d in lines:
+			datalist.append(Weather(d))
+	elif type == "rebalancing":
+		moments = cols['moment'].astype(dt.datetime)
+		for i in xrange(len(lines)):
+			datalist.append(Rebalancing(lines[i], moments[i]))
 	return datalist
 
-def read_all_data():
+def cache_filename(filename):
+	# Binary cache file kept next to a data file
+	return os.path.splitext(filename)[0] + '.cache.npz'
+
+def source_stamp(filename):
+	# Size and modification time of a file, stored with its cache
+	s = os.stat(filename)
+	return np.array([s.st_size, int(s.st_mtime * 1e6)], dtype=np.int64)
+
+def read_cache(filename):
+	# Returns the cached arrays for filename, or None if there is no cache
+	#   or the file has changed since the cache was written
+	cname = cache_filename(filename)
+	if not os.path.exists(cname):
+		return None
+	try:
+		with np.load(cname) as c:
+			cols = dict((k, c[k]) for k in c.files)
+	except (IOError, ValueError):
+		return None
+	if not np.array_equal(cols.pop('source_stamp'), source_stamp(filename)):
+		return None
+	return cols
+
+def write_cache(filename, cols):
+	# Saves the parsed arrays of filename, replacing any old cache
+	cname = cache_filename(filename)
+	temp = cname + '.tmp'
+	with open(temp, 'wb') as f:
+		np.savez(f, source_stamp=source_stamp(filename), **cols)
+	os.rename(temp, cname)
+	return
+
+def read_all_data(cache=True):
 	# Call this to load all the data files into big lists
 	# Note: currently ignores weather + rebalancing
-	trips = read_data("trip")
-	stations = read_data("station")
+	# cache: use the binary caches next to the data files (see read_data)
+	trips = read_data("trip", cache=cache)
+	stations = read_data("station", cache=cache)
 	return trips, stations
 
 def datefix(rawdate):
 	# Converts a raw date "mm/dd/yyyy" or "yyyy/mm/dd" into a datetime.date object
-	d = rawdate.strip('\r\n')
-	d = d.split("/")
-	if len(d[0])==4:
-		return dt.date(int(d[0]), int(d[1]), int(d[2]))
-	else:
-		return dt.date(int(d[2]), int(d[0]), int(d[1]))
+	return dt.date(*datetime_fields(rawdate)[:3])
 
 def timefix(rawtime):
 	# Converts a raw time into a datetime.time object
@@ -229,28 +935,148 @@ def timefix(rawtime):
 		return
 
 def dtfix(rawdt):
-	# Converts raw datetime string into a datetime object
-	x = rawdt.strip('\r\n')
-	x = x.split(" ")
+	# Converts raw datetime string into a datetime object (one string at a
+	#   time; use parse_datetimes for columns)
+	return dt.datetime(*datetime_fields(rawdt))
+
+def datetime_fields(rawdt):
+	# Splits one raw date or datetime string into
+	#   [year, month, day, hour, minute, second]
+	x = rawdt.strip('\r\n"').split(" ")
 	date = x[0].split("/")
-	time = x[1].split(":")
-	if len(date[0])==4:
-		year = int(date[0])
-		month = int(date[1])
-		day = int(date[2])
-	else:
-		year = int(date[2])
-		month = int(date[0])
-		day = int(date[1])
-	hour = int(time[0])
-	minute = int(time[1])
-	if len(time)==3:
-		second = int(time[2])
-	return dt.datetime(year,month,day,hour,minute,second=0)
+	if len(date[0]) != 4: # m/d/yyyy
+		date = [date[2], date[0], date[1]]
+	time = x[1].split(":") if len(x) > 1 else []
+	return [int(i) for i in date + time] + [0] * (3 - len(time))
+
+def parse_datetimes(rawdts):
+	# Converts a sequence of raw datetime strings into a datetime64[s] array.
+	#   Accepts "m/d/yyyy hh:mm" and "yyyy/mm/dd hh:mm:ss" (and plain dates).
+	#   Fixed width "yyyy/mm/dd hh:mm:ss" columns are read straight from the
+	#   bytes. Otherwise each distinct string is parsed once, all of them in a
+	#   single np.fromstring call when they share a layout.
+	a = np.array(rawdts, dtype=str)
+	if len(a) == 0:
+		return np.zeros(0, dtype='datetime64[s]')
+	fields = fixed_width_fields(a)
+	if fields is not None:
+		return fields_to_datetimes(fields)
+	raw, inverse = np.unique(a, return_inverse=True)
+	first = raw[0].strip('\r\n"')
+	width = first.count("/") + first.count(":") + 2 - (" " not in first)
+	# the vectorized path needs one layout: year first (or not) and the
+	#   same number of fields in every string
+	b = raw.view(np.uint8).reshape(len(raw), raw.dtype.itemsize)
+	slash = b == ord("/")
+	year_first = np.argmax(slash, axis=1) - (b[:,0] == ord('"')) == 4
+	widths = slash.sum(axis=1) + (b == ord(":")).sum(axis=1) + 2 \
+	         - ~(b == ord(" ")).any(axis=1)
+	if year_first.all() != year_first.any() or (widths != width).any():
+		fields = np.array([datetime_fields(x) for x in raw], dtype=np.int64)
+		return fields_to_datetimes(fields)[inverse]
+	text = " ".join(raw).replace('"', ' ')
+	text = text.replace("/", " ").replace(":", " ")
+	fields = np.fromstring(text, dtype=np.int64, sep=" ")
+	if fields.size == width * len(raw):
+		fields = fields.reshape(len(raw), width)
+		if first.index("/") != 4: # m/d/yyyy
+			fields[:,:3] = fields[:,[2,0,1]]
+		fields = np.hstack([fields, np.zeros((len(raw), 6 - width),
+		                                     dtype=np.int64)])
+	if fields.ndim != 2 or fields[:,1].min() < 1 or fields[:,1].max() > 12:
+		# mixed layouts, fall back to one string at a time
+		fields = np.array([datetime_fields(x) for x in raw], dtype=np.int64)
+	return fields_to_datetimes(fields)[inverse]
+
+def fixed_width_fields(a):
+	# Reads [year, month, day, hour, minute, second] columns out of an 'S'
+	#   array of "yyyy/mm/dd hh:mm:ss" strings (optionally quoted, with
+	#   trailing newlines). Returns None if any string has another layout.
+	lead = 1 if a[0][:1] == '"' else 0
+	if a.dtype.itemsize < lead + 19:
+		return None
+	b = a.view(np.uint8).reshape(len(a), a.dtype.itemsize)
+	b = b[:,lead:lead+19]
+	if not ((b[:,[4,7]] == ord('/')).all() and (b[:,10] == ord(' ')).all()
+	        and (b[:,[13,16]] == ord(':')).all()):
+		return None
+	digits = b[:,[0,1,2,3,5,6,8,9,11,12,14,15,17,18]].astype(np.int64) - 48
+	if digits.min() < 0 or digits.max() > 9:
+		return None
+	fields = np.zeros((len(a), 6), dtype=np.int64)
+	fields[:,0] = digits[:,0]*1000 + digits[:,1]*100 + digits[:,2]*10 \
+	              + digits[:,3]
+	for i in range(1, 6):
+		fields[:,i] = digits[:,2*i+2]*10 + digits[:,2*i+3]
+	return fields
+
+def fields_to_datetimes(fields):
+	# Converts an (n, 6) array of [year, month, day, hour, minute, second]
+	#   into a datetime64[s] array
+	months = (fields[:,0] - 1970) * 12 + fields[:,1] - 1
+	days = months.astype('datetime64[M]').astype('datetime64[D]') \
+	       + (fields[:,2] - 1)
+	seconds = fields[:,3] * 3600 + fields[:,4] * 60 + fields[:,5]
+	return days.astype('datetime64[s]') + seconds
+
+def parse_ints(rawints):
+	# Converts a sequence of raw (optionally quoted) integer strings into an
+	#   int64 array with a single np.fromstring call
+	text = " ".join(rawints).replace('"', ' ')
+	ints = np.fromstring(text, dtype=np.int64, sep=" ")
+	if len(ints) != len(rawints):
+		raise ValueError("non-integer data in column")
+	return ints
+
+def weekdays(moments):
+	# Day of week for a datetime64 array, Monday=0, Sunday=6
+	days = moments.astype('datetime64[D]').astype(np.int64)
+	return ((days + 3) % 7).astype(np.int8) # 1970-01-01 was a Thursday
+
+def station_codes(names):
+	# Converts a sequence of station names into an int16 array of station ids
+	#   (0 for unknown stations)
+	raw, inverse = np.unique(np.array(names, dtype=str), return_inverse=True)
+	ids = [int(station_name_to_id.get(x, "0")) for x in raw]
+	return np.array(ids, dtype=np.int16)[inverse]
+
+@instrumented('station_city_table')
+def station_city_table():
+	# Lookup array from integer station id to index in city_names (-1: none)
+	ids = [int(s) for c in stations_by_city for s in stations_by_city[c]]
+	ids += [int(s) for s in station_name_to_id.values()]
+	table = np.zeros(max(ids) + 1, dtype=np.int8) - 1
+	for c in stations_by_city:
+		for s in stations_by_city[c]:
+			table[int(s)] = city_names.index(c)
+	return table
+
+city_table = [] # station_city_table(), built on first use
+
+def station_city_codes(stations):
+	# city_names index of each station in an array of station ids
+	if not city_table:
+		city_table.append(station_city_table())
+	return city_table[0][stations]
+
+def route_codes(trip_table):
+	# Integer code of each trip's (start, end) route, see route_name
+	return trip_table.start_station.astype(np.int64) * 65536 \
+	       + trip_table.end_station
+
+def route_name(code):
+	# 'start,end' route key for a route code
+	return str(int(code) // 65536) + ',' + str(int(code) % 65536)
+
+def is_table(trip_data):
+	# True if trip_data is a TripTable rather than a list of Trips
+	return isinstance(trip_data, TripTable)
 
 def snap_filename(moment, lead='', type='csv'):
 	if type == 'csv':
 		ext = 'csv'
+	elif type == 'json':
+		ext = 'json'
 	else:
 		ext = 'txt'
 	f = "datafiles/"+lead+'_'+type+"_"+str(moment.month)+"-"\
@@ -258,8 +1084,24 @@ def snap_filename(moment, lead='', type='csv'):
 		+str(moment.hour)+"h"+str(moment.minute)+"m."+ext
 	return f
 
+def compact_json(obj):
+	# JSON text without whitespace for documents built from
+	#   SystemSnapshot.frame. Integer numpy arrays are written with a single
+	#   join, much faster than going through the generic encoder.
+	import simplejson as json
+	if isinstance(obj, np.ndarray) and obj.dtype.kind in 'iu':
+		return '[' + ','.join(map(str, obj.tolist())) + ']'
+	if isinstance(obj, (list, tuple, np.ndarray)):
+		return '[' + ','.join(compact_json(x) for x in obj) + ']'
+	if isinstance(obj, dict):
+		items = [json.dumps(k) + ':' + compact_json(obj[k]) for k in sorted(obj)]
+		return '{' + ','.join(items) + '}'
+	return json.dumps(obj)
+
 def all_trips_from(station_id, trip_data):
 	# Returns a subset of trip_data
+	if is_table(trip_data):
+		return trip_data.index().query(start_station=station_id)
 	trips = []
 	for t in trip_data:
 		if t.start_station == station_id:
@@ -268,6 +1110,8 @@ def all_trips_from(station_id, trip_data):
 
 def all_trips_to(station_id, trip_data):
 	# Returns a subset of trip_data
+	if is_table(trip_data):
+		return trip_data.index().query(end_station=station_id)
 	trips = []
 	for t in trip_data:
 		if t.end_station == station_id:
@@ -275,6 +1119,8 @@ def all_trips_to(station_id, trip_data):
 	return trips
 
 def all_trips_by_bike_id(trip_data, bikeid):
+	if is_table(trip_data):
+		return trip_data.index().query(bike_id=bikeid)
 	trips = []
 	for t in trip_data:
 		if t.bike_id == bikeid:
@@ -282,6 +1128,8 @@ def all_trips_by_bike_id(trip_data, bikeid):
 	return trips
 
 def all_trips_by_city(trip_data, city):
+	if is_table(trip_data):
+		return trip_data.index().query(city=city)
 	trips = []
 	for t in trip_data:
 		if t.city == city:
@@ -289,6 +1137,9 @@ def all_trips_by_city(trip_data, city):
 	return trips
 
 def weekday_split_trips(trip_data):
+	if is_table(trip_data):
+		weekend = trip_data.weekday > 4
+		return trip_data[~weekend], trip_data[weekend]
 	weekday = []
 	weekend = []
 	for t in trip_data:
@@ -300,9 +1151,13 @@ def weekday_split_trips(trip_data):
 
 def count_trips_by_start_hour(trip_data):
 	# Prints a count of trips in the trip_data list by start hour
-	hours = [0]*24
-	for t in trip_data:
-		hours[t.start_moment.hour] += 1
+	#   (also accepts a TripTable or an iter_data stream)
+	hours = np.zeros(24, dtype=np.int64)
+	for t in trip_batches(trip_data):
+		if is_table(t):
+			hours += np.bincount(t.start_hours(), minlength=24)
+		else:
+			hours[t.start_moment.hour] += 1
 	for h in range(24):
 		print '%s trips in hour %s' % (hours[h], h)
 	return
@@ -320,70 +1175,109 @@ def compress_rebalancing_datafile(\
 	# Compresses the rebalancing data file into a shorter one by
 	#   removing redundant lines of data.
 	if n=="all":
-		n = data_file_lengths["rebalancing"]
-	with open(fname, "w") as writefile:
-		with open(data_file_names["rebalancing"]) as f:
-			# copy header and first line to new file
-			writefile.write(f.readline()) # header
-			first = f.readline() # first data line
-			writefile.write(first)
-			check = first.split(',"201')[0]
-			# scan datalines. copy new ones, ignore redundant ones
-			for i in xrange(n):
-				l = f.readline()
-				if l == "":
-					break
-				s = l.split(',"201')
-				if s[0] != check:
-					check = s[0]
-					writefile.write(l)
-	return
+		n = None
+	return stream_rebalancing_data(compressed=fname, station_files=False, n=n)
 
 def compressed_rebalancing_station_sort(\
 	fname="datafiles/rebalancing_compressed_data.csv"):
 	# splits the compressed rebalancing data file by station id
-	with open(fname) as f:
+	return stream_rebalancing_data(source=fname, compressed=None)
+
+class StationWriterPool:
+	# Buffered writers for per-station csv files. Lines are kept in a
+	#   buffer per station and appended to the station's file in one write
+	#   when the buffer fills up, so no file stays open between writes.
+	def __init__(self, pattern, header, buffer_lines=4096):
+		# pattern: file name with a %s for the station id
+		self.pattern = pattern
+		self.header = header
+		self.buffer_lines = buffer_lines
+		self.buffers = {}
+		self.started = set() # stations whose file has been created
+		return
+
+	def write(self, station, line):
+		b = self.buffers.setdefault(station, [])
+		b.append(line)
+		if len(b) >= self.buffer_lines:
+			self.flush(station)
+		return
+
+	def flush(self, station):
+		if station in self.started:
+			mode = 'a'
+		else:
+			mode = 'w'
+			self.buffers[station].insert(0, self.header)
+			self.started.add(station)
+		with open(self.pattern % station, mode) as f:
+			f.write(''.join(self.buffers[station]))
+		self.buffers[station] = []
+		return
+
+	def close(self):
+		for s in self.buffers:
+			if self.buffers[s] or s not in self.started:
+				self.flush(s)
+		return
+
+@instrumented('stream_rebalancing_data',\
+	lambda result, *args, **kwargs: result['rows_in'])
+def stream_rebalancing_data(source=raw_rebalancing_file,\
+	compressed=data_file_names["rebalancing"], station_files=True, n=None):
+	# Single pass over the raw rebalancing feed. Drops readings that repeat
+	#   the previous bikes/docks of the same station, writes the remaining
+	#   lines to the compressed file and/or per-station files, and returns
+	#   (and prints) rows in, rows out and throughput.
+	# compressed: output file name, or None to skip it
+	# station_files: also write datafiles/rebalancing_station_N.csv
+	# n: only read the first n data lines
+	start = dt.datetime.now()
+	rows_in = 0
+	rows_out = 0
+	last = {} # station: last kept 'station,bikes,docks'
+	pool = None
+	out = None
+	with open(source) as f:
 		header = f.readline()
-		i = 3 # first data line in the loop
-		l = f.readline()
-		cs = l.split(',')[0]
-		writefile = open('datafiles/rebalancing_data_station_'+cs.strip('"')+'.csv','w')
-		writefile.write(header)
-		writefile.write(l)
-		while i < 453903: # Not robust if source file changes!
-			# read line
-			l = f.readline()
-			# check if current station
-			temp = l.split(',')[0]
-			if temp != cs:
-				writefile.close()
-				writefile = open('datafiles/rebalancing_data_station_'+temp.strip('"')+'.csv','w')
-				writefile.write(header)
-				cs = temp
-			writefile.write(l)
-			i += 1
-		writefile.close()
-	return
+		if compressed is not None:
+			out = open(compressed, 'w', 1 << 20)
+			out.write(header)
+		if station_files:
+			pool = StationWriterPool(\
+				'datafiles/rebalancing_station_%s.csv', header)
+		for l in itertools.islice(f, n):
+			if not l.strip():
+				continue
+			rows_in += 1
+			reading = l.rsplit(',', 1)[0]
+			station = reading.split(',', 1)[0]
+			if last.get(station) == reading:
+				continue
+			last[station] = reading
+			rows_out += 1
+			if out is not None:
+				out.write(l)
+			if pool is not None:
+				pool.write(station.strip('"'), l)
+	if out is not None:
+		out.close()
+	if pool is not None:
+		pool.close()
+	seconds = max((dt.datetime.now() - start).total_seconds(), 1e-6)
+	stats = {'rows_in': rows_in, 'rows_out': rows_out, 'seconds': seconds,
+	         'rows_per_second': rows_in / seconds}
+	print '%s rows in, %s rows out, %.0f rows/s' % \
+	      (rows_in, rows_out, stats['rows_per_second'])
+	return stats
 
 def rebalancing_station_snapshot(station, datetime):
 	# Returns the # of bikes at a specific station and moment
-	rfile = "datafiles/rebalancing_station_"+station+".csv"
-	with open(rfile) as f:
-		f.readline() # clear header
-		new = f.readline()
-		d = new.split(',')[3]
-		d = d.strip('\n')
-		d = dtfix(d)
-		if d > datetime:
-			print "station not open yet"
-			return None
-		while d < datetime:
-			old = new
-			new = f.readline()
-			d = new.split(',')[3]
-			d = d.strip('\n')
-			d = dtfix(d)
-	return int(old.split(',')[1])
+	bikes = rebalancing_index().bikes_at(station, datetime)
+	if bikes < 0:
+		print "station not open yet"
+		return None
+	return int(bikes)
 
 def compress_node_files():
 	# Compresses all node files into a single file for
@@ -435,32 +1329,119 @@ def append_elevation_data(fname = 'datafiles/raw_elevation_data.txt'):
 					nsf.write(sl.strip('\n')+','+rl[2]+'\n')
 	return
 
-def compile_all_routes(trip_data, station_data):
-	weekday, weekend = weekday_split_trips(trip_data)
-	routes = {} # k: 'start,end' v:[weekday trips, weekend trips, elevation]
-	for t in weekday:
-		if t.route in routes:
-			routes[t.route][0] += 1
+@instrumented('compile_all_routes', length_of('trip_data', 0))
+def compile_all_routes(trip_data, station_data, incremental=False,\
+	path='datafiles/routes.npz'):
+	# Writes routes.csv: weekday/weekend rides and elevation change per route
+	# incremental: merge trip_data into the aggregates saved at path (only
+	#   trips with ids above the last merged one) instead of starting over
+	if incremental:
+		routes = RouteAggregates.load(path)
+	else:
+		routes = RouteAggregates()
+	routes.add(trip_data)
+	if incremental:
+		routes.save(path)
+	routes.write_csv('datafiles/routes.csv', station_data)
+	return routes
+
+class RouteAggregates:
+	# Per-route totals over trip data, as arrays sorted by route code (see
+	#   route_codes): weekday and weekend rides and duration count, sum, sum
+	#   of squares, min and max. New trips are merged in with add().
+	fields = ['codes', 'weekday', 'weekend', 'duration_sum',
+	          'duration_sumsq', 'duration_min', 'duration_max']
+
+	def __init__(self, **arrays):
+		# arrays: saved fields (see load), empty aggregates if not given
+		self.codes = arrays.get('codes', np.zeros(0, dtype=np.int64))
+		for f in self.fields[1:]:
+			setattr(self, f, arrays.get(f, np.zeros(0, dtype=np.float64)))
+		self.last_id = int(arrays.get('last_id', -1))
+		return
+
+	@classmethod
+	def load(cls, path):
+		# Aggregates saved at path, or empty ones if there is no file
+		if not os.path.exists(path):
+			return cls()
+		with np.load(path) as a:
+			return cls(**dict((k, a[k]) for k in a.files))
+
+	def save(self, path):
+		arrays = dict((f, getattr(self, f)) for f in self.fields)
+		np.savez(path, last_id=self.last_id, **arrays)
+		return
+
+	def __len__(self):
+		return len(self.codes)
+
+	def add(self, trip_data):
+		# Merges the trips with ids above last_id into the aggregates
+		if is_table(trip_data):
+			ids, codes = trip_data.id, route_codes(trip_data)
+			weekend, dur = trip_data.weekday > 4, trip_data.duration
 		else:
-			routes[t.route] = [1,0]
-	for t in weekend:
-		if t.route in routes:
-			routes[t.route][1] += 1
-		else: # no weekday trip or weekend trip yet on this route
-			routes[t.route] = [0,1]
-	sdict = stations_as_dict(station_data)
-	for r in routes:
-		se = r.split(',')
-		elev = sdict[se[1]].elevation - sdict[se[0]].elevation
-		routes[r].append(elev)
-	with open('datafiles/routes.csv','w') as wf:
-		header = "start_station,end_station,weekday_rides,weekend_rides,elevation_change(m)\n"
-		wf.write(header)
-		for r in routes:
-			l = r + ',' + str(routes[r][0]) + ',' + str(routes[r][1])\
-				+ ',' + '{:.4}'.format(routes[r][2]) + '\n'
-			wf.write(l)
-	return
+			ids = np.array([int(t.id) for t in trip_data], dtype=np.int64)
+			codes = np.array([int(t.start_station) * 65536 + int(t.end_station)
+			                  for t in trip_data], dtype=np.int64)
+			weekend = np.array([t.weekday > 4 for t in trip_data], dtype=bool)
+			dur = np.array([t.duration for t in trip_data], dtype=np.int64)
+		new = ids > self.last_id
+		if not new.any():
+			return
+		codes, weekend = codes[new], weekend[new]
+		dur = dur[new].astype(np.float64)
+		self.last_id = int(ids[new].max())
+		# one grouped pass over old routes and new trips together
+		n = len(self.codes)
+		keys, g = np.unique(np.concatenate([self.codes, codes]),
+		                    return_inverse=True)
+		old, g = g[:n], g[n:]
+		m = len(keys)
+		def total(prev, w):
+			return np.bincount(old, prev, m) + np.bincount(g, w, m)
+		self.weekday = total(self.weekday, ~weekend)
+		self.weekend = total(self.weekend, weekend)
+		self.duration_sum = total(self.duration_sum, dur)
+		self.duration_sumsq = total(self.duration_sumsq, dur * dur)
+		lo = np.zeros(m) + np.inf
+		hi = np.zeros(m) - np.inf
+		np.minimum.at(lo, old, self.duration_min)
+		np.minimum.at(lo, g, dur)
+		np.maximum.at(hi, old, self.duration_max)
+		np.maximum.at(hi, g, dur)
+		self.duration_min, self.duration_max = lo, hi
+		self.codes = keys
+		return
+
+	def duration_stats(self):
+		# (mean, standard deviation) of trip duration per route, in seconds
+		n = self.weekday + self.weekend
+		mean = self.duration_sum / n
+		var = np.maximum(self.duration_sumsq / n - mean * mean, 0)
+		return mean, np.sqrt(var)
+
+	def elevation_change(self, station_data):
+		# End minus start station elevation per route, in meters
+		elev = np.zeros(65536) # indexed by station id
+		for s in station_data:
+			elev[int(s.id)] = s.elevation
+		return elev[self.codes % 65536] - elev[self.codes // 65536]
+
+	def write_csv(self, fname, station_data):
+		elev = self.elevation_change(station_data)
+		with open(fname, 'w') as wf:
+			header = "start_station,end_station,weekday_rides,weekend_rides,elevation_change(m)\n"
+			wf.write(header)
+			lines = []
+			for i in xrange(len(self.codes)):
+				lines.append(route_name(self.codes[i]) + ','\
+				  + str(int(self.weekday[i])) + ','\
+				  + str(int(self.weekend[i])) + ','\
+				  + '{:.4}'.format(elev[i]) + '\n')
+			wf.write(''.join(lines))
+		return
 
 def tableau_friendly_routes(routefile='datafiles/routes.csv'):
 	with open(routefile) as rf:
@@ -497,130 +1478,87 @@ def station_routes_path(station_id, routefile='datafiles/routes_path.csv'):
 					wf.write(b)
 	return
 
-def compile_empty_full():
-	for s in range(2,83):
-		try:
-			empty_full_by_station(s)
-		except:
-			continue
-	return
-
-def empty_full_by_station(station_id):
-	station_id = str(station_id)
-	rfname = 'datafiles/rebalancing_station_'+ station_id + '.csv'
-	wfename = 'datafiles/empty_station_' + station_id + '.csv'
-	wffname = 'datafiles/full_station_' + station_id + '.csv'
-	eheader = 'station_id,num_bikes,start_moment,end_moment\n'
-	fheader = 'station_id,num_docks,start_moment,end_moment\n'
-	with open(rfname, 'r') as rf:
-		with open(wfename, 'wb') as wfe:
-			with open(wffname, 'wb') as wff:
-				wfe.write(eheader) # write empty header
-				wff.write(fheader) # write full header
-				rf.readline() # clear header
-				e = ''
-				f = ''
-				while True:
-					l = rf.readline().strip('\r\n')
-					if l == '':
-						break
-					d = l.split(',')
-					# Check for previously empty/full station
-					if e != '':
-						line = e + ',' + d[3] + '\n'
-						wfe.write(line)
-						e = ''
-					elif f != '':
-						line = f + ',' + d[3] + '\n'
-						wff.write(line)
-						f = ''
-					# Check for currently empty/full station
-					if d[1] == '1' or d[1] == '0':
-						e = d[0]+','+d[1]+','+d[3]
-					elif d[2] == '1' or d[2] == '0':
-						f = d[0]+','+d[2]+','+d[3]
-	return
-
-def percentages_empty_full():
+@instrumented('percentages_empty_full')
+def percentages_empty_full(since=None, until=None):
 	# Creates stations_empty_full.csv which contains percentages of problematic
-	#   bike/dock counts for each station
-	stations = {}
-	with open('datafiles/station_data.csv') as sf: # create dict of stations
-		sf.readline() # clear header
-		while True:
-			l = sf.readline()
-			if l=='':
-				break
-			l = l.split(',')
-			stations[l[0]] = {'station_id':l[0], 'total_seconds':0, \
-			                  'distribution':[0,0,0,0,0]} # from empty to full
-			start_date = datefix(l[6])
-			if start_date < dt.date(2013,8,29):
-				start_date = dt.date(2013,8,29)
-			end_date = dt.date(2013,3,1)
-			date_diff = end_date - start_date
-			stations[l[0]]['total_seconds'] = date_diff.total_seconds()
-
-	for s in stations: # load data from each station (empty_station_N.csv files)
-		try:
-			with open('datafiles/empty_station_'+s+'.csv') as ef: # load empties
-				ef.readline()
-				while True:
-					l = ef.readline()
-					if l=='':
-						break
-					d = l.split(',')
-					duration = dtfix(d[2]) - dtfix(d[3])
-					duration = duration.total_seconds()
-					if d[1]=='1':
-						stations[s]['distribution'][1] += duration
-					else:
-						stations[s]['distribution'][0] += duration
-		except:
-			continue
-		try:
-			with open('datafiles/full_station_'+s+'.csv') as ff: # load fulls
-				ff.readline()
-				while True:
-					l = ff.readline()
-					if l=='':
-						break
-					d = l.split(',')
-					duration = dtfix(d[2]) - dtfix(d[3])
-					duration = duration.total_seconds()
-					if d[1]=='1':
-						stations[s]['distribution'][3] += duration
-					else:
-						stations[s]['distribution'][4] += duration
-		except:
-			continue
-		stations[s]['distribution'][2] = stations[s]['total_seconds'] - \
-		                                 stations[s]['distribution'][0] - \
-																		 stations[s]['distribution'][1] - \
-																		 stations[s]['distribution'][3] - \
-																		 stations[s]['distribution'][4]
-		for i in range(5): # express as percentages
-			stations[s]['distribution'][i] = stations[s]['distribution'][i] / \
-			                                 stations[s]['total_seconds']
-
+	#   bike/dock counts for each station, over [since, until) if given
+	stations, seconds = dwell_states(since=since, until=until)
+	total = seconds.sum(axis=1)
 	header = 'station_id,empty,onebike,ok,onedock,full\n'
 	with open('datafiles/stations_empty_full.csv','wb') as wf:
 		wf.write(header)
-		for s in sorted([int(i) for i in stations.keys()]):
-			line = str(s)+','
-			for i in range(5):
-				line += '{:.5%}'.format(stations[str(s)]['distribution'][i])
-				if i < 4:
-					line += ','
-			line += '\n'
-			wf.write(line)
+		for s in xrange(len(stations)):
+			if total[s] == 0:
+				continue
+			line = str(stations[s])+','
+			line += ','.join(['{:.5%}'.format(seconds[s][i] / total[s])
+			                  for i in range(5)])
+			wf.write(line + '\n')
 	return
 
+dwell_state_names = ['empty', 'onebike', 'ok', 'onedock', 'full']
+
+@instrumented('dwell_states')
+def dwell_states(index=None, since=None, until=None, by_hour=False):
+	# Seconds each station spent in each availability state (see
+	#   dwell_state_names) in one pass over the rebalancing time series.
+	#   Each reading lasts until the station's next reading (the last one
+	#   until the end of the data), clipped to [since, until).
+	# Returns (station ids, seconds): seconds has shape (stations, 5), or
+	#   (stations, 24, 5) split by hour of day with by_hour=True.
+	if index is None:
+		index = rebalancing_index()
+	time = np.asarray(index.time).astype(np.int64)
+	station = np.asarray(index.station)
+	bikes = np.asarray(index.bikes)
+	freedocks = np.asarray(index.freedocks)
+	stations = index.stations()
+	if len(time) == 0:
+		shape = (0, 24, 5) if by_hour else (0, 5)
+		return stations, np.zeros(shape)
+	lo = time.min() if since is None else \
+	     np.datetime64(since, 's').astype(np.int64)
+	hi = time.max() if until is None else \
+	     np.datetime64(until, 's').astype(np.int64)
+	# interval of each reading: until the next reading of the same station
+	end = np.append(time[1:], hi)
+	last = np.append(station[1:] != station[:-1], True)
+	end[last] = hi
+	start = np.maximum(time, lo)
+	end = np.minimum(end, hi)
+	state = np.select([bikes == 0, bikes == 1, freedocks == 0,
+	                   freedocks == 1], [0, 1, 4, 3], 2)
+	row = np.searchsorted(stations, station)
+	keep = end > start
+	start, end, state, row = start[keep], end[keep], state[keep], row[keep]
+	if not by_hour:
+		seconds = np.bincount(row * 5 + state, end - start,
+		                      len(stations) * 5)
+		return stations, seconds.reshape(len(stations), 5)
+	# split intervals at hour boundaries
+	first = start // 3600
+	pieces = (end - 1) // 3600 - first + 1
+	i = np.repeat(np.arange(len(start)), pieces)
+	j = np.arange(len(i)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+	hour = first[i] + j
+	length = np.minimum(end[i], (hour + 1) * 3600) - \
+	         np.maximum(start[i], hour * 3600)
+	bins = (row[i] * 24 + hour % 24) * 5 + state[i]
+	seconds = np.bincount(bins, length, len(stations) * 24 * 5)
+	return stations, seconds.reshape(len(stations), 24, 5)
+
 def popular_stations(trip_data, n=5):
 	# Returns a list of the n most popular stations by # trips
+	#   (also accepts a TripTable or an iter_data stream)
 	s = {}
 	# compile dict of trips by station
-	for t in trip_data:
+	for t in trip_batches(trip_data):
+		if is_table(t):
+			counts = np.bincount(np.concatenate([t.start_station,
+			                                     t.end_station]))
+			for i in np.flatnonzero(counts):
+				s[str(i)] = s.get(str(i), 0) + int(counts[i])
+			continue
 		if t.start_station not in s:
 			s[t.start_station] = 0
 		s[t.start_station] += 1
@@ -641,25 +1579,31 @@ def stations_as_dict(station_data_list):
 def animate_bike_availability(reb_data, time_delta=1):
 	# animates the number of bikes available at a station over time
 	# reb_data = a list of Rebalancing objects
+	# time_delta = show every time_delta-th reading
+	# (see animate.py for all stations at once)
+	from matplotlib import pyplot as plt
+	from matplotlib import animation
 	n = reb_data[0].docks
-	cg = color_gradient(n)
+	cg = color_gradient(n+1) # one color per possible bike count
 
 	fig = plt.figure()
 	ax = fig.add_subplot(111)
 	ax.set_ylim(0,27)
 	ax.set_xlim(0,2)
-
-	anim = animation.FuncAnimation(fig, animator, blit=True)
-	plt.show()
+	point, = ax.plot([1], [reb_data[0].bikes], '.', markersize=20.0)
 
 	def animator(i):
-		# Plots the proper color for bike availability at the
-		# given date+time tuple d_t
-		b = reb_data[i].bikes
-		plt.plot(1, b, '.', markersize=20.0, color=cg[b])
-		return plt
+		# Moves and recolors the single point for bike availability
+		#   at reading i
+		b = min(reb_data[i].bikes, n)
+		point.set_data([1], [b])
+		point.set_color(cg[b])
+		return point,
 
-	return
+	anim = animation.FuncAnimation(fig, animator, blit=True,\
+		frames=xrange(0, len(reb_data), time_delta))
+	plt.show()
+	return anim
 
 def color_gradient(n, s = (0,.75,0), f = (1,0,.3)):
 	# returns an n-length array of color code tuples from start to finish
@@ -686,11 +1630,6 @@ if __name__ == "__main__":
 	'''
 	trips, stations = read_all_data()
 	tripgraph = TripGraph(trips)
-	year = 2014
-	month = 1
-	day = 15
-	for hour in range(24):
-		for minute in range(0,60,15):
-			moment = dt.datetime(year, month, day, hour, minute)
-			snapshot = SystemSnapshot(tripgraph, moment)
-			snapshot.output_csvs()'''
+	day = dt.datetime(2014, 1, 15)
+	for snapshot in SnapshotSeries(tripgraph, day, day+dt.timedelta(days=1)):
+		snapshot.output_csvs()'''
@@ -0,0 +1,288 @@
+'''
+Benchmarks for the bikeshare pipelines
+
+Run "python bench.py" to time them on synthetic data (see synthdata.py)
+and write the results as JSON; pass --compare with an earlier results file
+to flag regressions.
+'''
+
+import argparse
+import datetime as dt
+import json
+import multiprocessing
+import os
+import Queue
+import resource
+import subprocess
+import sys
+import time
+import synthdata
+
+scales = {'144k': 144000, '1m': 1000000, '10m': 10000000}
+
+def bench_import(module='analytics', runs=10):
+	# Cold start time of "import module" in fresh interpreters, in seconds.
+	#   Each run subtracts a bare interpreter start made right before it,
+	#   so slow spells on the machine cancel out.
+	here = os.path.dirname(os.path.abspath(__file__))
+	def cold(code):
+		start = time.time()
+		subprocess.check_call([sys.executable, '-c', code], cwd=here)
+		return time.time() - start
+	times = sorted(cold('import ' + module) - cold('pass') for i in range(runs))
+	return {'name': 'import_' + module, 'seconds': times[runs // 2]} # median
+
+def prepare_data(workdir, trips, seed=0):
+	# Generates the synthetic data files in workdir unless the same ones
+	#   are already there
+	manifest = os.path.join(workdir, 'manifest.json')
+	wanted = {'trips': trips, 'seed': seed}
+	if os.path.exists(manifest):
+		with open(manifest) as f:
+			if json.load(f) == wanted:
+				return
+	synthdata.generate(workdir, trips=trips, seed=seed)
+	with open(manifest, 'w') as f:
+		json.dump(wanted, f)
+	return
+
+def setup_cold_cache():
+	# Removes the trip data cache, so the next cached read builds it
+	from base import cache_filename, data_file_names
+	cname = cache_filename(data_file_names['trip'])
+	if os.path.exists(cname):
+		os.remove(cname)
+	return None
+
+def setup_trips():
+	from base import read_data, read_all_data
+	trips, stations = read_all_data(cache=False)
+	return {'trips': trips, 'stations': stations}
+
+def setup_graph():
+	from base import TripGraph, rebalancing_index
+	state = setup_trips()
+	state['graph'] = TripGraph(state['trips'])
+	rebalancing_index()
+	return state
+
+def run_read_data(state):
+	from base import read_data
+	return len(read_data('trip'))
+
+def run_read_data_cached(state):
+	from base import read_data
+	return len(read_data('trip', cache=True))
+
+def run_trip_graph(state):
+	from base import TripGraph
+	TripGraph(state['trips'])
+	return len(state['trips'])
+
+def run_system_snapshot(state):
+	from base import SystemSnapshot
+	moment = dt.datetime(2013, 9, 2, 8, 30)
+	SystemSnapshot(state['graph'], moment)
+	return len(state['trips'])
+
+def run_snapshot_series(state):
+	from base import SnapshotSeries
+	day = dt.datetime(2013, 9, 2)
+	frames = list(SnapshotSeries(state['graph'], day, day + dt.timedelta(days=1)))
+	return len(frames)
+
+def run_compile_all_routes(state):
+	from base import compile_all_routes
+	compile_all_routes(state['trips'], state['stations'])
+	return len(state['trips'])
+
+def run_popular_stations(state):
+	from base import popular_stations
+	popular_stations(state['trips'])
+	return len(state['trips'])
+
+def run_rebalancing_stream(state):
+	from base import stream_rebalancing_data
+	return stream_rebalancing_data()['rows_in']
+
+def run_rebalancing_index(state):
+	from base import RebalancingIndex, rebalancing_index_path
+	return len(RebalancingIndex.build(rebalancing_index_path).time)
+
+# (name, setup, run): run returns the number of rows it processed.
+#   Order matters: the rebalancing stream writes the file the index reads.
+pipelines = [
+	('read_data_trip', None, run_read_data),
+	('read_data_trip_cached', setup_cold_cache, run_read_data_cached),
+	('read_data_trip_cached_warm', None, run_read_data_cached),
+	('rebalancing_compact_split', None, run_rebalancing_stream),
+	('rebalancing_index_build', None, run_rebalancing_index),
+	('trip_graph', setup_trips, run_trip_graph),
+	('system_snapshot', setup_graph, run_system_snapshot),
+	('snapshot_series_day', setup_graph, run_snapshot_series),
+	('compile_all_routes', setup_trips, run_compile_all_routes),
+	('popular_stations', setup_trips, run_popular_stations),
+]
+
+def reset_peak_rss():
+	# Restarts the kernel's peak RSS count (VmHWM) at the current RSS, so
+	#   one run's peak can be read on its own. False where not supported
+	#   (Linux before 4.0, other systems).
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+		return peak_rss_kb() is not None
+	except IOError:
+		return False
+
+def peak_rss_kb():
+	# VmHWM of this process in KB, None if /proc does not have it
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])
+	except IOError:
+		pass
+	return None
+
+def run_isolated(name, setup, run, queue, repeats):
+	# Runs one pipeline benchmark repeats times in a child process (setup
+	#   before each run) and reports the median and minimum time. peak
+	#   growth is the first run's peak RSS above the RSS it started with,
+	#   so imports and setup are not counted (where the peak cannot be
+	#   reset, how far the run raised the process' peak).
+	from instrument import rss_kb
+	try:
+		import base
+		times = []
+		for i in range(repeats):
+			state = None
+			state = setup() if setup else None
+			if i == 0:
+				reset = reset_peak_rss()
+				before = rss_kb() if reset else \
+				         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			start = time.time()
+			rows = run(state)
+			times.append(time.time() - start)
+			if i == 0:
+				peak = peak_rss_kb() if reset else \
+				       resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+				growth = (peak - before) / 1024.0
+		seconds = sorted(times)[len(times) // 2]
+		queue.put({'name': name, 'seconds': seconds, 'min_seconds': min(times),
+		           'runs': repeats, 'rows': rows,
+		           'rows_per_second': rows / max(seconds, 1e-9),
+		           'peak_growth_mb': growth})
+	except Exception:
+		import traceback
+		queue.put({'name': name, 'error': traceback.format_exc()})
+	return
+
+def bench_pipelines(workdir, repeats=5, timeout=3600):
+	# Times every entry of pipelines with the data files in workdir.
+	#   A pipeline that fails (or whose process dies, or takes more than
+	#   timeout seconds) gets an 'error' entry instead of timings.
+	here = os.getcwd()
+	os.chdir(workdir)
+	results = []
+	try:
+		for name, setup, run in pipelines:
+			queue = multiprocessing.Queue()
+			p = multiprocessing.Process(target=run_isolated,
+			                            args=(name, setup, run, queue, repeats))
+			p.start()
+			results.append(child_result(name, p, queue, timeout))
+			p.join()
+	finally:
+		os.chdir(here)
+	return results
+
+def child_result(name, p, queue, timeout):
+	# The result run_isolated put on queue, or an error entry if process p
+	#   ended without one or ran out of time
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			return queue.get(timeout=1)
+		except Queue.Empty:
+			if not p.is_alive():
+				try: # anything it sent just before exiting
+					return queue.get(timeout=1)
+				except Queue.Empty:
+					return {'name': name, 'error': 'process exited with code '
+					                               + str(p.exitcode)}
+	p.terminate()
+	return {'name': name, 'error': 'timed out after %d s' % timeout}
+
+def compare(results, previous, tolerance=0.3, floor=0.025):
+	# Names of the benchmarks whose median run is more than tolerance (a
+	#   fraction) and more than floor seconds slower than in the previous
+	#   results, so one slow run or a few ms of noise do not count
+	old = dict((r['name'], r) for r in previous['results'] if 'error' not in r)
+	slower = []
+	for r in results['results']:
+		if 'error' in r or r['name'] not in old:
+			continue
+		before = old[r['name']]['seconds']
+		if r['seconds'] - before > max(before * tolerance, floor):
+			slower.append(r['name'])
+	return slower
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--output', default='bench_results.json')
+	parser.add_argument('--compare', help='earlier results file')
+	parser.add_argument('--tolerance', type=float, default=0.3,
+	                    help='allowed slowdown of the median run, as a fraction')
+	parser.add_argument('--floor', type=float, default=0.025,
+	                    help='slowdowns up to this many seconds never count')
+	parser.add_argument('--repeats', type=int, default=5,
+	                    help='runs per pipeline (median and fastest are kept)')
+	parser.add_argument('--scale', choices=sorted(scales), default='144k',
+	                    help='number of synthetic trips')
+	parser.add_argument('--workdir', help='where to keep the synthetic data '
+	                    '(default: bench_data/<scale>)')
+	parser.add_argument('--imports-only', action='store_true')
+	parser.add_argument('--import-limit', type=float, default=0.05,
+	                    help='maximum seconds importing analytics may take '
+	                         'beyond importing numpy on the same machine')
+	args = parser.parse_args(argv)
+	results = {'python': sys.version.split()[0], 'time': time.time(),
+	           'scale': args.scale,
+	           'results': [bench_import(), bench_import('numpy')]}
+	if not args.imports_only:
+		workdir = args.workdir or os.path.join('bench_data', args.scale)
+		prepare_data(workdir, scales[args.scale])
+		results['results'] += bench_pipelines(workdir, args.repeats)
+	for r in results['results']:
+		if 'error' in r:
+			print '%-30s FAILED\n%s' % (r['name'], r['error'])
+			continue
+		line = '%-30s %9.4f s' % (r['name'], r['seconds'])
+		if 'rows' in r:
+			line += ' %12.0f rows/s %8.1f MB peak growth' % \
+			        (r['rows_per_second'], r['peak_growth_mb'])
+		print line
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent=1)
+	failed = []
+	errors = [r['name'] for r in results['results'] if 'error' in r]
+	# numpy's own import time varies by machine, only our overhead counts
+	analytics, numpy = [r['seconds'] for r in results['results'][:2]]
+	print '%-30s %9.4f s' % ('import_analytics - numpy', analytics - numpy)
+	if analytics - numpy > args.import_limit:
+		failed.append('import_analytics')
+	if args.compare:
+		with open(args.compare) as f:
+			failed += compare(results, json.load(f), args.tolerance,
+			                  args.floor)
+	for name in failed:
+		print 'REGRESSION: ' + name
+	for name in errors:
+		print 'FAILED: ' + name
+	return 1 if failed or errors else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,8 +1,8 @@
 '''
 constant variables for bikeshare analysis
 '''
+import collections
 import datetime as dt
-import simplejson as json
 
 day_one = dt.date(2013,8,29) # A Thursday!
 
@@ -16,6 +16,7 @@ for f in ["trip", "weather"]:
 	data_file_names[f] = "datafiles/201402_" + f + "_data.csv"
 data_file_names["station"] = "datafiles/station_data.csv"
 data_file_names["rebalancing"] = "datafiles/rebalancing_compressed_data.csv"
+raw_rebalancing_file = "datafiles/201402_rebalancing_data.csv"
 
 # center_latlon is the "center" lat,lon pair for a city
 center_latlon = {"San Francisco": [37.77865, -122.418235],\
@@ -31,12 +32,40 @@ latlon_scale = {"San Francisco":  [110992.27,88095.77],\
 				"Palo Alto":      [110985.96,88491.42],\
 				"Mountain View":  [110984.93,88555.88]}
 
-# station name<->id dicts:
-with open("datafiles/station_dict.txt") as f:
-	station_name_to_id = json.loads(f.read())
-station_id_to_name = {}
-for k in station_name_to_id:
-	station_id_to_name[station_name_to_id[k]] = k
+class LazyDict(collections.Mapping):
+	# Read-only dict whose contents are built by loader() on first use
+	def __init__(self, loader):
+		self.loader = loader
+		self.data = None
+
+	def load(self):
+		if self.data is None:
+			self.data = self.loader()
+		return self.data
+
+	def __getitem__(self, k):
+		return self.load()[k]
+
+	def __iter__(self):
+		return iter(self.load())
+
+	def __len__(self):
+		return len(self.load())
+
+def load_station_dict():
+	import simplejson as json
+	with open("datafiles/station_dict.txt") as f:
+		return json.loads(f.read())
+
+def invert_station_dict():
+	station_id_to_name = {}
+	for k in station_name_to_id:
+		station_id_to_name[station_name_to_id[k]] = k
+	return station_id_to_name
+
+# station name<->id dicts, read from datafiles/station_dict.txt when first used:
+station_name_to_id = LazyDict(load_station_dict)
+station_id_to_name = LazyDict(invert_station_dict)
 	
 # stations by city
 stations_by_city = {"San Francisco":['41','42','45','46','47','48','49','50','51','53','54','55','56','57','58','59','60','61','62','63','64','65','66','67','68','69','70','71','72','73','74','75','76','77','82'],\
@@ -45,4 +74,6 @@ stations_by_city = {"San Francisco":['41','42','45','46','47','48','49','50','51
 					"Palo Alto":['34','35','36','37','38'],\
 					"Mountain View":['27','28','29','30','31','32','33']}
 					
-city_codes = {"San Francisco":"SF","San Jose":"SJ","Redwood City":"RC","Palo Alto":"PA","Mountain View":"MV"}
\ No newline at end of file
+city_codes = {"San Francisco":"SF","San Jose":"SJ","Redwood City":"RC","Palo Alto":"PA","Mountain View":"MV"}
+
+city_names = sorted(stations_by_city.keys()) # index = TripTable city code
@@ -0,0 +1,115 @@
+'''
+Exporting a series of system snapshots to combined, frame indexed files
+
+One nodes file and one edges file hold every frame, replacing the per
+moment output_csvs files and the compress_node_files step.
+'''
+
+import gzip
+from base import *
+from instrument import instrumented
+
+nodes_header = 'frame,time,station_id,available_bikes\n'
+edges_header = 'frame,time,start_station,end_station,num_bikes\n'
+
+@instrumented('export_series')
+def export_series(snapshots, nodes_file, edges_file, format='csv',\
+	chunk_frames=96):
+	# Writes every SystemSnapshot in snapshots (e.g. a SnapshotSeries) to
+	#   one nodes file and one edges file, numbering frames from 0.
+	# format: 'csv', 'gzip' (gzipped csv), 'parquet' or 'feather' (the last
+	#   two need pandas with pyarrow)
+	# chunk_frames: csv output is written in one block per this many frames
+	if format in ('parquet', 'feather'):
+		return export_series_frame(snapshots, nodes_file, edges_file, format)
+	if format == 'gzip':
+		nf, ef = gzip.open(nodes_file, 'wb'), gzip.open(edges_file, 'wb')
+	elif format == 'csv':
+		nf, ef = open(nodes_file, 'w', 1 << 20), open(edges_file, 'w', 1 << 20)
+	else:
+		raise ValueError("unknown export format: " + str(format))
+	try:
+		nf.write(nodes_header)
+		ef.write(edges_header)
+		nodes, edges = [], []
+		for frame, snapshot in enumerate(snapshots):
+			lead = str(frame)+','+frame_time(snapshot.moment)+','
+			for n in snapshot.nodes:
+				nodes.append(lead+n+','+str(snapshot.nodes[n])+'\n')
+			for e in snapshot.edges:
+				edges.append(lead+e+','+str(snapshot.edges[e])+'\n')
+			if (frame + 1) % chunk_frames == 0:
+				nf.write(''.join(nodes))
+				ef.write(''.join(edges))
+				nodes, edges = [], []
+		nf.write(''.join(nodes))
+		ef.write(''.join(edges))
+	finally:
+		nf.close()
+		ef.close()
+	return
+
+def export_series_frame(snapshots, nodes_file, edges_file, format):
+	# Parquet / Feather output of export_series through pandas
+	try:
+		import pandas as pd
+	except ImportError:
+		raise ImportError("pandas (with pyarrow) is needed for " + format)
+	nodes = {'frame': [], 'time': [], 'station_id': [], 'available_bikes': []}
+	edges = {'frame': [], 'time': [], 'start_station': [], 'end_station': [],
+	         'num_bikes': []}
+	for frame, snapshot in enumerate(snapshots):
+		time = frame_time(snapshot.moment)
+		for n in snapshot.nodes:
+			nodes['frame'].append(frame)
+			nodes['time'].append(time)
+			nodes['station_id'].append(int(n))
+			b = snapshot.nodes[n]
+			nodes['available_bikes'].append(-1 if b is None else b)
+		for e in snapshot.edges:
+			s, t = e.split(',')
+			edges['frame'].append(frame)
+			edges['time'].append(time)
+			edges['start_station'].append(int(s))
+			edges['end_station'].append(int(t))
+			edges['num_bikes'].append(snapshot.edges[e])
+	for cols, fname, header in [(nodes, nodes_file, nodes_header),
+	                            (edges, edges_file, edges_header)]:
+		df = pd.DataFrame(cols, columns=header.strip().split(','))
+		if format == 'parquet':
+			df.to_parquet(fname)
+		else:
+			df.to_feather(fname)
+	return
+
+@instrumented('export_json_series')
+def export_json_series(snapshots, fname, delta=True, keyframe_interval=96):
+	# Writes every SystemSnapshot in snapshots to fname as one compact JSON
+	#   document: {"stations": [station ids], "frames": [frames]}, each
+	#   frame from SystemSnapshot.frame. With delta, frames only hold the
+	#   changes from the previous frame when that is shorter than the full
+	#   frame (it is not when most stations change), and every
+	#   keyframe_interval-th frame is always full.
+	snapshots = iter(snapshots)
+	first = next(snapshots, None)
+	stations = first.station_list() if first is not None else []
+	with open(fname, 'w', 1 << 20) as f:
+		f.write('{"stations":' + compact_json(np.array(stations, dtype=np.int64))
+		        + ',"frames":[')
+		previous = None
+		frame = 0
+		for snapshot in itertools.chain([first] if first else [], snapshots):
+			text = compact_json(snapshot.frame(stations))
+			if delta and frame % keyframe_interval != 0:
+				changes = compact_json(snapshot.frame(stations, previous))
+				if len(changes) < len(text):
+					text = changes
+			f.write((',' if frame else '') + text)
+			previous = snapshot
+			frame += 1
+		f.write(']}')
+	return
+
+def frame_time(moment):
+	# hour:minute label of a frame, as in compress_node_files
+	return str(moment.hour)+':'+str(moment.minute)
@@ -0,0 +1,110 @@
+'''
+Fleet engine: per bike trip chains, idle gaps and implied relocations
+
+Trips are sorted by bike and start time once, and every per bike statistic
+is a grouped reduction over the sorted arrays.
+'''
+
+from base import *
+
+class Fleet:
+	# Trips of a TripTable grouped by bike. order holds trip positions
+	#   sorted by (bike_id, start_moment); the trips of bikes[b] are
+	#   order[offsets[b]:offsets[b+1]]. A link joins each trip to the next
+	#   trip of the same bike: its idle gap is the time between them, and
+	#   it is a relocation if the bike was moved (by staff) between the
+	#   first trip's end station and the next trip's start station.
+	def __init__(self, trip_table):
+		self.trips = trip_table
+		t = trip_table
+		self.order = np.lexsort((t.start_moment, t.bike_id))
+		bike_id = t.bike_id[self.order]
+		self.bikes, first, self.bike_of = np.unique(bike_id, return_index=True,
+		                                            return_inverse=True)
+		self.offsets = np.append(first, len(self.order))
+		self.start = t.start_moment[self.order].astype(np.int64)
+		self.end = t.end_moment[self.order].astype(np.int64)
+		self.start_station = t.start_station[self.order]
+		self.end_station = t.end_station[self.order]
+		# links: sorted trip i to i+1, where both are the same bike's
+		self.linked = bike_id[1:] == bike_id[:-1]
+		self.gap = np.where(self.linked, self.start[1:] - self.end[:-1], 0)
+		self.relocated = self.linked & \
+		                 (self.end_station[:-1] != self.start_station[1:])
+		return
+
+	def rows(self, bike):
+		# Slice of the sorted trips for one bike_id
+		b = np.searchsorted(self.bikes, bike)
+		if b == len(self.bikes) or self.bikes[b] != bike:
+			return slice(0, 0)
+		return slice(self.offsets[b], self.offsets[b+1])
+
+	def chain(self, bike):
+		# TripTable of one bike's trips in order
+		return self.trips[self.order[self.rows(bike)]]
+
+	def gaps(self, bike):
+		# Idle seconds between each of one bike's trips and the next
+		r = self.rows(bike)
+		return self.gap[r.start:max(r.stop - 1, r.start)]
+
+	def relocations(self):
+		# Every implied relocation as a dict of arrays: bike, from_station,
+		#   to_station, and the window it happened in (after, before)
+		i = np.flatnonzero(self.relocated)
+		return {'bike': self.bikes[self.bike_of[i]],
+		        'from_station': self.end_station[i],
+		        'to_station': self.start_station[i + 1],
+		        'after': self.end[i].astype('datetime64[s]'),
+		        'before': self.start[i + 1].astype('datetime64[s]')}
+
+	def stats(self):
+		# Per bike statistics as a dict of arrays aligned with bikes:
+		#   trips, ride/idle/span seconds (span: first start to last end),
+		#   utilization (ride / span), mean and max idle gap, relocations
+		#   and relocation_rate (relocations per link)
+		n = len(self.bikes)
+		if n == 0:
+			return dict((k, np.zeros(0)) for k in ['bike', 'trips',
+			            'ride_seconds', 'idle_seconds', 'span_seconds',
+			            'utilization', 'mean_idle', 'max_idle',
+			            'relocations', 'relocation_rate'])
+		first = self.offsets[:-1]
+		trips = np.diff(self.offsets)
+		duration = self.trips.duration[self.order]
+		ride = np.bincount(self.bike_of, weights=duration, minlength=n)
+		owner = self.bike_of[:-1]
+		idle_gap = np.maximum(self.gap, 0)
+		idle = np.bincount(owner, weights=idle_gap, minlength=n)
+		links = trips - 1
+		relocations = np.bincount(owner[self.relocated], minlength=n)
+		span = np.maximum.reduceat(self.end, first) - self.start[first]
+		# gap after each sorted trip (0 for a bike's last trip)
+		after = np.append(idle_gap, 0)
+		return {'bike': self.bikes,
+		        'trips': trips,
+		        'ride_seconds': ride,
+		        'idle_seconds': idle,
+		        'span_seconds': span,
+		        'utilization': ride / np.maximum(span, 1),
+		        'mean_idle': idle / np.maximum(links, 1),
+		        'max_idle': np.maximum.reduceat(after, first),
+		        'relocations': relocations,
+		        'relocation_rate': relocations / np.maximum(links, 1.0)}
+
+	def write_csv(self, fname='datafiles/fleet.csv'):
+		# One row of stats() per bike
+		s = self.stats()
+		with open(fname, 'w') as wf:
+			wf.write('bike_id,trips,ride_seconds,idle_seconds,span_seconds,'
+			         'utilization,max_idle,relocations\n')
+			lines = []
+			for i in xrange(len(s['bike'])):
+				lines.append('%d,%d,%d,%d,%d,%.4f,%d,%d\n' % (s['bike'][i],
+				             s['trips'][i], s['ride_seconds'][i],
+				             s['idle_seconds'][i], s['span_seconds'][i],
+				             s['utilization'][i], s['max_idle'][i],
+				             s['relocations'][i]))
+			wf.write(''.join(lines))
+		return
@@ -0,0 +1,136 @@
+'''
+Rebalancing demand forecasts: time until each station runs empty or full
+
+Net flow profiles (arrivals minus departures) are kept per station, day
+of week and 15 minute slot, and played forward from the current bike count.
+'''
+
+from base import *
+
+slots_per_day = 96 # 15 minute slots
+
+class FlowProfiles:
+	# Trip arrivals and departures per (station, weekday, slot) as count
+	#   arrays, plus the dates they cover. add() merges new trips (ids above
+	#   the last merged one), so the profiles can be saved and kept current.
+	def __init__(self, arrivals=None, departures=None, dates=None,\
+		last_id=-1):
+		shape = (0, 7, slots_per_day)
+		self.arrivals = np.zeros(shape) if arrivals is None else arrivals
+		self.departures = np.zeros(shape) if departures is None else departures
+		self.dates = np.zeros(0, dtype=np.int64) if dates is None else dates
+		self.last_id = int(last_id)
+		return
+
+	@classmethod
+	def load(cls, path):
+		# Profiles saved at path, or empty ones if there is no file
+		if not os.path.exists(path):
+			return cls()
+		with np.load(path) as a:
+			return cls(**dict((k, a[k]) for k in a.files))
+
+	def save(self, path):
+		np.savez(path, arrivals=self.arrivals, departures=self.departures,
+		         dates=self.dates, last_id=self.last_id)
+		return
+
+	def add(self, trip_table):
+		# Merges the trips of a TripTable with ids above last_id
+		trips = trip_table[trip_table.id > self.last_id]
+		if len(trips) == 0:
+			return
+		self.last_id = int(trips.id.max())
+		n = max(len(self.arrivals),
+		        int(trips.start_station.max()) + 1,
+		        int(trips.end_station.max()) + 1)
+		self.arrivals = self.grow(self.arrivals, n)
+		self.departures = self.grow(self.departures, n)
+		self.departures += slot_counts(trips.start_station,
+		                               trips.start_moment, n)
+		self.arrivals += slot_counts(trips.end_station, trips.end_moment, n)
+		days = np.concatenate([trips.start_moment, trips.end_moment])
+		days = days.astype('datetime64[D]').astype(np.int64)
+		self.dates = np.union1d(self.dates, days)
+		return
+
+	def grow(self, counts, n):
+		# counts padded with zero rows up to n stations
+		if len(counts) >= n:
+			return counts
+		pad = np.zeros((n - len(counts), 7, slots_per_day))
+		return np.concatenate([counts, pad])
+
+	def net_flow(self):
+		# Mean arrivals minus departures per (station, weekday, slot)
+		days = np.bincount((self.dates + 3) % 7, minlength=7)
+		days = np.maximum(days, 1).reshape(1, 7, 1)
+		return (self.arrivals - self.departures) / days
+
+def day_slots(moments):
+	# 15 minute slot of the day (0-95) of each moment in a datetime64 array
+	minutes = (moments - moments.astype('datetime64[D]')).astype('timedelta64[m]')
+	return minutes.astype(np.int64) // (24 * 60 // slots_per_day)
+
+def slot_counts(stations, moments, n):
+	# Trip counts per (station, weekday, slot) as an (n, 7, slots) array
+	bins = (stations.astype(np.int64) * 7 + weekdays(moments)) \
+	       * slots_per_day + day_slots(moments)
+	counts = np.bincount(bins, minlength=n * 7 * slots_per_day)
+	return counts.reshape(n, 7, slots_per_day).astype(np.float64)
+
+profiles_path = 'datafiles/flow_profiles.npz'
+loaded_profiles = []
+
+def flow_profiles(trip_data=None, path=profiles_path):
+	# FlowProfiles cached at path (and in memory), updated with trip_data
+	#   if given
+	if not loaded_profiles:
+		loaded_profiles.append(FlowProfiles.load(path))
+	profiles = loaded_profiles[0]
+	if trip_data is not None:
+		last = profiles.last_id
+		profiles.add(trip_data)
+		if profiles.last_id != last:
+			profiles.save(path)
+	return profiles
+
+def forecast_empty_full(moment, profiles=None, index=None,\
+	horizon=dt.timedelta(hours=24)):
+	# Predicts, for every station, the seconds from moment until it runs
+	#   out of bikes and of free docks (inf if not within horizon), from
+	#   its current bike count and its mean net flow per upcoming slot.
+	# Returns a dict of arrays: station, bikes, docks, to_empty, to_full
+	if profiles is None:
+		profiles = flow_profiles()
+	if index is None:
+		index = rebalancing_index()
+	stations, bikes, freedocks = index.snapshot(moment)
+	open_ = bikes >= 0
+	stations, bikes, freedocks = stations[open_], bikes[open_], freedocks[open_]
+	docks = bikes + freedocks
+	slot_seconds = 24 * 3600 // slots_per_day
+	m = np.datetime64(moment, 's')
+	into_slot = (m - m.astype('datetime64[D]')).astype(np.int64) % slot_seconds
+	first = (m - into_slot).astype(np.int64) // slot_seconds
+	steps = max(int(horizon.total_seconds() // slot_seconds), 1)
+	absolute = first + np.arange(steps)
+	slot = absolute % slots_per_day
+	weekday = (absolute // slots_per_day + 3) % 7
+	net = profiles.net_flow()
+	rows = np.zeros((len(stations), steps))
+	known = stations < len(net)
+	rows[known] = net[stations[known]][:, weekday, slot]
+	# expected bikes now and at the end of each slot, and seconds until then
+	expected = bikes.reshape(-1, 1) + np.cumsum(rows, axis=1)
+	expected = np.hstack([bikes.reshape(-1, 1), expected])
+	ends = np.append(0, (np.arange(steps) + 1) * slot_seconds - into_slot)
+	return {'station': stations, 'bikes': bikes, 'docks': docks,
+	        'to_empty': first_crossing(expected <= 0, ends),
+	        'to_full': first_crossing(expected >= docks.reshape(-1, 1), ends)}
+
+def first_crossing(hit, ends):
+	# For each row of the boolean (stations, steps) array hit, the value of
+	#   ends at the first True column, inf if there is none
+	first = np.argmax(hit, axis=1)
+	return np.where(hit.any(axis=1), ends[first], np.inf)
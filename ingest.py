@@ -0,0 +1,319 @@
+'''
+Live ingestion: append new trips and dock readings without a full reload
+
+Appended rows are merged into the indexes and aggregates with work
+proportional to their number, and checkpoint() saves the state so a
+restart resumes where it stopped.
+'''
+
+import shutil
+import time
+from base import *
+from forecast import FlowProfiles
+from odcube import ODCube
+
+class ReadingsIndex(RebalancingIndex):
+	# RebalancingIndex over in-memory reading arrays rather than files
+	def __init__(self, station, time, bikes, freedocks):
+		order = np.lexsort((time, station))
+		self.path = None
+		self.station = station[order]
+		self.time = time[order]
+		self.bikes = bikes[order]
+		self.freedocks = freedocks[order]
+		n = int(station.max()) + 2 if len(station) else 1
+		self.offsets = np.searchsorted(self.station, np.arange(n))
+		return
+
+class RebalancingLog:
+	# A RebalancingIndex on disk plus the readings appended since it was
+	#   written (the tail), with the same lookups as the index (value_at,
+	#   bikes_at, freedocks_at, stations, snapshot), so it can be passed
+	#   wherever an index is expected. A reading is kept only if it is
+	#   newer than its station's latest one, so replayed (and out of
+	#   order) rows are dropped.
+	def __init__(self, path, tail=None):
+		# path: RebalancingIndex directory, created empty if missing
+		# tail: dict of station, time, bikes, freedocks arrays to append;
+		#   readings the index already holds (saved before a compact()
+		#   that finished) are dropped like any replayed reading
+		recover_index(path)
+		if not os.path.exists(os.path.join(path, 'offsets.npy')):
+			RebalancingIndex.write(path, *rebalancing_columns([]),
+			                       stamp=np.zeros(2, dtype=np.int64))
+		self.path = path
+		self.index = RebalancingIndex(path)
+		self.latest = np.zeros(len(self.index.offsets), dtype=np.int64) \
+		              + np.iinfo(np.int64).min # by station id, in seconds
+		s = self.index.stations()
+		self.latest[s] = self.index.time[self.index.offsets[s+1] - 1]\
+		                 .astype(np.int64)
+		self.chunks = []
+		self.tail = None # ReadingsIndex over chunks, built on first lookup
+		if tail is not None:
+			self.append(tail['station'], tail['time'], tail['bikes'],
+			            tail['freedocks'])
+		return
+
+	def append(self, station, time, bikes, freedocks):
+		# Adds readings (arrays, any order), returns how many were new
+		order = np.lexsort((time, station))
+		station, time = station[order], time[order]
+		seconds = time.astype(np.int64)
+		if len(station) and station.max() >= len(self.latest):
+			grown = np.zeros(int(station.max()) + 1, dtype=np.int64) \
+			        + np.iinfo(np.int64).min
+			grown[:len(self.latest)] = self.latest
+			self.latest = grown
+		# of readings with the same station and time the last one counts,
+		#   as in RebalancingIndex lookups
+		repeat = np.append((station[1:] == station[:-1])
+		                   & (seconds[1:] == seconds[:-1]), False)
+		new = (seconds > self.latest[station]) & ~repeat
+		if not new.any():
+			return 0
+		np.maximum.at(self.latest, station[new], seconds[new])
+		self.chunks.append({'station': station[new], 'time': time[new],
+		                    'bikes': bikes[order][new],
+		                    'freedocks': freedocks[order][new]})
+		self.tail = None
+		return int(new.sum())
+
+	def tail_arrays(self):
+		# dict of the appended readings as four arrays
+		cols = ['station', 'time', 'bikes', 'freedocks']
+		if not self.chunks:
+			return dict(zip(cols, rebalancing_columns([])))
+		return dict((c, np.concatenate([k[c] for k in self.chunks]))
+		            for c in cols)
+
+	def tail_index(self):
+		if self.tail is None:
+			a = self.tail_arrays()
+			self.tail = ReadingsIndex(a['station'], a['time'], a['bikes'],
+			                          a['freedocks'])
+		return self.tail
+
+	def __len__(self):
+		return len(self.index.time) + sum(len(k['time']) for k in self.chunks)
+
+	def tail_length(self):
+		return sum(len(k['time']) for k in self.chunks)
+
+	def value_at(self, column, station, moments):
+		# Tail readings are newer than the index's, so they win when both
+		#   have one at or before a moment
+		tail = self.tail_index()
+		base = self.index.value_at(column, station, moments)
+		recent = getattr(tail, column)
+		if len(recent) == 0:
+			return base
+		i = tail.lookup(station, moments)
+		return np.where(i >= 0, recent[np.maximum(i, 0)], base)
+
+	def bikes_at(self, station, moments):
+		return self.value_at('bikes', station, moments)
+
+	def freedocks_at(self, station, moments):
+		return self.value_at('freedocks', station, moments)
+
+	def stations(self):
+		return np.union1d(self.index.stations(), self.tail_index().stations())
+
+	def snapshot(self, moment):
+		# (station ids, bikes, freedocks) at moment, see RebalancingIndex
+		stations = self.stations()
+		bikes = np.array([self.bikes_at(s, moment) for s in stations],
+		                 dtype=np.int64)
+		freedocks = np.array([self.freedocks_at(s, moment) for s in stations],
+		                     dtype=np.int64)
+		return stations, bikes, freedocks
+
+	def compact(self):
+		# Rewrites the index on disk with the tail merged in
+		if not self.chunks:
+			return
+		a = self.tail_arrays()
+		cols = [np.concatenate([np.asarray(getattr(self.index, c)), a[c]])
+		        for c in ['station', 'time', 'bikes', 'freedocks']]
+		temp = self.path + '.tmp'
+		old = self.path + '.old'
+		shutil.rmtree(temp, True)
+		RebalancingIndex.write(temp, *cols, stamp=np.zeros(2, dtype=np.int64))
+		os.rename(self.path, old)
+		os.rename(temp, self.path)
+		shutil.rmtree(old, True)
+		self.index = RebalancingIndex(self.path)
+		self.chunks = []
+		self.tail = None
+		return
+
+def recover_index(path):
+	# Finishes or rolls back a RebalancingLog.compact() that was cut short.
+	#   compact() writes path.tmp completely, renames path to path.old,
+	#   path.tmp to path, then deletes path.old; so if path is missing,
+	#   path.tmp is the finished new index.
+	temp = path + '.tmp'
+	old = path + '.old'
+	if not os.path.exists(path) and os.path.exists(old):
+		os.rename(temp if os.path.exists(temp) else old, path)
+	shutil.rmtree(temp, True)
+	shutil.rmtree(old, True)
+	return
+
+class LiveState:
+	# Trips, dock readings and the aggregates over them (RouteAggregates,
+	#   FlowProfiles, ODCube), kept in directory path. Rows come in with
+	#   append_trips / append_rebalancing (raw data lines, e.g. from a feed)
+	#   or ingest_file (the lines added to a data file since the last
+	#   call). Trips are kept if their id is above the last one seen.
+	#   checkpoint() saves everything and LiveState(path) resumes from it;
+	#   appended rows are kept as tails next to the saved tables and
+	#   merged into them once a tail reaches compact_ratio of the table.
+	def __init__(self, path='datafiles/live', compact_ratio=0.25):
+		self.path = path
+		self.compact_ratio = compact_ratio
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.base_trips = self.load_trips('trips.npz')
+		tail = self.load_trips('trips_tail.npz')
+		if len(self.base_trips) and len(tail):
+			# a checkpoint that merged the tail into trips.npz but stopped
+			#   before clearing trips_tail.npz leaves them in both
+			tail = tail[tail.id > self.base_trips.id.max()]
+		self.trip_chunks = [tail] if len(tail) else []
+		self.table = None
+		ids = [t.id.max() for t in [self.base_trips, tail] if len(t)]
+		self.last_id = int(max(ids)) if ids else -1
+		self.routes = RouteAggregates.load(self.file('routes.npz'))
+		self.profiles = FlowProfiles.load(self.file('flow_profiles.npz'))
+		cube = self.file('od_cube')
+		if os.path.exists(os.path.join(cube, 'counts.npy')):
+			self.cube = ODCube(cube)
+		else:
+			self.cube = ODCube.build(cube, self.trips())
+		tail = None
+		if os.path.exists(self.file('rebalancing_tail.npz')):
+			with np.load(self.file('rebalancing_tail.npz')) as a:
+				tail = dict((k, a[k]) for k in a.files)
+		self.rebalancing = RebalancingLog(self.file('rebalancing_index'), tail)
+		self.sources = {} # data file: byte offset read up to
+		if os.path.exists(self.file('sources.json')):
+			import simplejson as json
+			with open(self.file('sources.json')) as f:
+				self.sources = json.load(f)
+		return
+
+	def file(self, name):
+		return os.path.join(self.path, name)
+
+	def load_trips(self, name):
+		if not os.path.exists(self.file(name)):
+			return TripTable.from_lines([])
+		with np.load(self.file(name)) as a:
+			return TripTable(**dict((k, a[k]) for k in a.files))
+
+	def trips(self):
+		# All trips as one TripTable; rebuilt (with its index) after appends
+		if self.table is None:
+			self.table = TripTable.concatenate([self.base_trips] +
+			                                   self.trip_chunks)
+		return self.table
+
+	def append_trips(self, lines):
+		# Adds raw trip data lines (no header), returns how many were new
+		lines = [l for l in lines if l.strip()]
+		table = TripTable.from_lines(lines)
+		new = table[table.id > self.last_id]
+		if len(new) == 0:
+			return 0
+		self.trip_chunks.append(new)
+		self.table = None
+		self.last_id = int(new.id.max())
+		self.routes.add(new)
+		self.profiles.add(new)
+		self.cube.add(new)
+		return len(new)
+
+	def append_rebalancing(self, lines):
+		# Adds raw rebalancing data lines (no header), returns how many
+		#   readings were new
+		d = zip(*[l.rstrip('\r\n').split(',') for l in lines if l.strip()])
+		return self.rebalancing.append(*rebalancing_columns(d))
+
+	def ingest_file(self, fname, type, block=64 << 20):
+		# Appends the complete lines written to a "trip" or "rebalancing"
+		#   data file since the last call (from the top, after the header,
+		#   the first time), in blocks of about block bytes. Returns the
+		#   number of new rows.
+		offset = self.sources.get(fname, 0)
+		if os.path.getsize(fname) < offset:
+			offset = 0 # file replaced by a shorter one, read it again
+		append = self.append_trips if type == 'trip' else \
+		         self.append_rebalancing
+		added = 0
+		with open(fname, 'rb') as f:
+			f.seek(offset)
+			if offset == 0:
+				f.readline() # clear header
+			while True:
+				data = f.read(block)
+				end = data.rfind('\n') + 1
+				if end == 0:
+					break # nothing, or a line still being written
+				added += append(data[:end].splitlines())
+				f.seek(f.tell() - len(data) + end)
+				self.sources[fname] = f.tell()
+		return added
+
+	def follow(self, files, interval=10, checkpoint_every=300):
+		# Polls files, a list of (data file, type) pairs, every interval
+		#   seconds and checkpoints every checkpoint_every seconds, until
+		#   interrupted
+		saved = time.time()
+		try:
+			while True:
+				for fname, type in files:
+					self.ingest_file(fname, type)
+				if time.time() - saved >= checkpoint_every:
+					self.checkpoint()
+					saved = time.time()
+				time.sleep(interval)
+		except KeyboardInterrupt:
+			self.checkpoint()
+		return
+
+	@instrumented('LiveState.checkpoint')
+	def checkpoint(self):
+		# Saves the tails (or merges them into the tables, see
+		#   compact_ratio), the aggregates, and last the file offsets
+		tail = TripTable.concatenate(self.trip_chunks) if self.trip_chunks \
+		       else TripTable.from_lines([])
+		if len(tail) > self.compact_ratio * len(self.base_trips):
+			self.base_trips = self.trips()
+			self.trip_chunks = []
+			save_arrays(self.file('trips.npz'), self.base_trips.as_columns())
+			tail = TripTable.from_lines([])
+		elif len(self.trip_chunks) > 1:
+			self.trip_chunks = [tail]
+		save_arrays(self.file('trips_tail.npz'), tail.as_columns())
+		log = self.rebalancing
+		if log.tail_length() > self.compact_ratio * len(log.index.time):
+			log.compact()
+		save_arrays(self.file('rebalancing_tail.npz'), log.tail_arrays())
+		self.routes.save(self.file('routes.npz'))
+		self.profiles.save(self.file('flow_profiles.npz'))
+		import simplejson as json
+		with open(self.file('sources.json.tmp'), 'w') as f:
+			json.dump(self.sources, f)
+		os.rename(self.file('sources.json.tmp'), self.file('sources.json'))
+		return
+
+def save_arrays(fname, arrays):
+	# np.savez to fname through a temporary file, so a crash never leaves
+	#   a half written file behind
+	temp = fname + '.tmp'
+	with open(temp, 'wb') as f:
+		np.savez(f, **arrays)
+	os.rename(temp, fname)
+	return
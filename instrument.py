@@ -0,0 +1,179 @@
+'''
+Opt-in timing and memory instrumentation for the analysis pipeline
+
+Stages are marked with the instrumented decorator or the stage context
+manager. Nothing is recorded until enable() is called; while disabled a
+stage costs one flag check.
+
+	import instrument
+	instrument.enable(profile='run.prof')
+	trips, stations = read_all_data()
+	...
+	instrument.disable()
+	print instrument.report()
+'''
+
+import functools
+import os
+import resource
+import time
+
+enabled = False
+stats = {} # stage name: Stat
+profiler = []
+settings = {}
+
+class Stat:
+	# Totals for one stage name
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.seconds = 0.0
+		self.rows = 0
+		self.rss_change_kb = 0 # change of the current RSS over the stage
+		self.peak_growth_kb = 0 # increase of the process' peak RSS
+		self.allocated = 0 # bytes, with enable(trace_memory=True)
+		self.traced = False # allocated is measured (tracemalloc running)
+
+	def rows_per_second(self):
+		return self.rows / self.seconds if self.seconds else 0.0
+
+class stage:
+	# Context manager recording one run of a named stage. Set .rows inside
+	#   the block to record how many rows it processed.
+	def __init__(self, name, rows=0):
+		self.name = name
+		self.rows = rows
+
+	def __enter__(self):
+		if enabled:
+			self.rss = rss_kb()
+			self.peak = peak_rss_kb()
+			self.traced = traced_memory()
+			self.start = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		if not enabled or not hasattr(self, 'start'):
+			return False
+		seconds = time.time() - self.start
+		s = stats.setdefault(self.name, Stat(self.name))
+		s.calls += 1
+		s.seconds += seconds
+		s.rows += self.rows or 0
+		s.rss_change_kb += rss_kb() - self.rss
+		s.peak_growth_kb += peak_rss_kb() - self.peak
+		if settings.get('trace_memory'):
+			s.allocated += max(traced_memory() - self.traced, 0)
+			s.traced = True
+		return False
+
+def instrumented(name, rows=None):
+	# Decorator recording every call of a function as stage name.
+	# rows: function of (result, *args, **kwargs) giving the rows
+	#   processed (see length_of); if it fails the call records 0 rows,
+	#   the result is returned unchanged either way
+	def decorate(f):
+		@functools.wraps(f)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return f(*args, **kwargs)
+			with stage(name) as s:
+				result = f(*args, **kwargs)
+				if rows is not None:
+					try:
+						s.rows = rows(result, *args, **kwargs)
+					except Exception:
+						s.rows = 0
+			return result
+		return wrapper
+	return decorate
+
+def length_of(name, position):
+	# rows callback for instrumented: len() of the argument name, passed
+	#   by keyword or at position (counting self or cls)
+	def rows(result, *args, **kwargs):
+		return len(kwargs[name] if name in kwargs else args[position])
+	return rows
+
+page_kb = os.sysconf('SC_PAGE_SIZE') // 1024 if hasattr(os, 'sysconf') else 4
+
+def rss_kb():
+	# Current resident set size of the process, in KB (Linux /proc; the
+	#   peak RSS where that is not available)
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * page_kb
+	except (IOError, IndexError, ValueError):
+		return peak_rss_kb()
+
+def peak_rss_kb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def traced_memory():
+	# Bytes currently traced by tracemalloc, 0 if it is not running
+	if not settings.get('trace_memory'):
+		return 0
+	import tracemalloc
+	return tracemalloc.get_traced_memory()[0]
+
+def enable(profile=None, trace_memory=False):
+	# Starts recording stages.
+	# profile: file to write cProfile stats to on disable()
+	# trace_memory: count allocated bytes per stage with tracemalloc
+	#   (Python 3 only, ignored where it is not available)
+	global enabled
+	settings.clear()
+	settings['profile'] = profile
+	if trace_memory:
+		try:
+			import tracemalloc
+			tracemalloc.start()
+			settings['trace_memory'] = True
+		except ImportError:
+			pass
+	if profile:
+		import cProfile
+		profiler[:] = [cProfile.Profile()]
+		profiler[0].enable()
+	enabled = True
+	return
+
+def disable(memory_dump=None):
+	# Stops recording, writes the cProfile stats if enable() asked for
+	#   them, and a tracemalloc snapshot to memory_dump if given
+	global enabled
+	enabled = False
+	if profiler:
+		profiler[0].disable()
+		profiler[0].dump_stats(settings['profile'])
+		del profiler[:]
+	if settings.get('trace_memory'):
+		import tracemalloc
+		if memory_dump:
+			tracemalloc.take_snapshot().dump(memory_dump)
+		tracemalloc.stop()
+		settings['trace_memory'] = False
+	return
+
+def reset():
+	stats.clear()
+	return
+
+def report():
+	# Summary table of the recorded stages, slowest first
+	# rss+: change of the current RSS (memory the stage kept), peak+: how
+	#   far it raised the process' peak RSS. Allocations are only known
+	#   with tracemalloc (Python 3), the column is left out otherwise.
+	traced = any(s.traced for s in stats.values())
+	header = '%-32s %6s %10s %12s %12s %10s %10s' % ('stage', 'calls',
+	         'seconds', 'rows', 'rows/s', 'rss+ MB', 'peak+ MB')
+	lines = [header + (' %10s' % 'alloc MB' if traced else '')]
+	for s in sorted(stats.values(), key=lambda s: -s.seconds):
+		line = '%-32s %6d %10.4f %12d %12.0f %10.1f %10.1f' % (s.name,
+		       s.calls, s.seconds, s.rows, s.rows_per_second(),
+		       s.rss_change_kb / 1024.0, s.peak_growth_kb / 1024.0)
+		if traced:
+			line += ' %10.1f' % (s.allocated / 1048576.0)
+		lines.append(line)
+	return '\n'.join(lines)
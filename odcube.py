@@ -0,0 +1,221 @@
+'''
+Origin-destination cube: trip counts per route, weekday, slot and rider type
+
+One dense array of shape stations x stations x 7 x 96 x sub types, saved
+as a .npy file and memory mapped, so OD questions are slices and sums.
+'''
+
+from base import *
+from instrument import length_of
+from forecast import slots_per_day, day_slots
+
+sub_type_names = ['Customer', 'Subscriber'] # last axis of the cube
+weekday_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+                 'Saturday', 'Sunday']
+
+class ODCube:
+	# Trip counts by start station, end station, weekday (Monday=0), 15
+	#   minute slot of the start moment and sub_type_names index. Station
+	#   axes are indexed by station id. Saved in directory path as
+	#   counts.npy and last_id.npy; add() merges trips with ids above
+	#   last_id, so the cube can be kept current.
+	def __init__(self, path, mmap_mode='r'):
+		# path: directory written by ODCube.build
+		self.path = path
+		self.counts = np.load(os.path.join(path, 'counts.npy'),
+		                      mmap_mode=mmap_mode)
+		self.last_id = int(np.load(os.path.join(path, 'last_id.npy')))
+		return
+
+	@classmethod
+	@instrumented('ODCube.build', length_of('trip_table', 2))
+	def build(cls, path, trip_table):
+		# Counts the trips of a TripTable and writes the cube to path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		ids = [int(s) for c in stations_by_city for s in stations_by_city[c]]
+		n = max(ids) + 1
+		if len(trip_table):
+			n = max(n, int(trip_table.start_station.max()) + 1,
+			        int(trip_table.end_station.max()) + 1)
+		counts = od_counts(trip_table, n)
+		np.save(os.path.join(path, 'counts.npy'), counts)
+		last_id = int(trip_table.id.max()) if len(trip_table) else -1
+		np.save(os.path.join(path, 'last_id.npy'), last_id)
+		return cls(path)
+
+	def add(self, trip_table):
+		# Merges the trips of a TripTable with ids above last_id and saves
+		#   the cube. Only the cells of the new trips are written, unless a
+		#   new station id makes the cube grow.
+		trips = trip_table[trip_table.id > self.last_id]
+		if len(trips) == 0:
+			return
+		fname = os.path.join(self.path, 'counts.npy')
+		n = max(len(self.counts), int(trips.start_station.max()) + 1,
+		        int(trips.end_station.max()) + 1)
+		if n > len(self.counts):
+			grown = np.zeros((n, n) + self.counts.shape[2:],
+			                 dtype=self.counts.dtype)
+			grown[:len(self.counts), :len(self.counts)] = self.counts
+			grown += od_counts(trips, n)
+			# new file renamed over the old one (still memory mapped), and
+			#   last_id only saved once the counts are in place
+			with open(fname + '.tmp', 'wb') as f:
+				np.save(f, grown)
+			os.rename(fname + '.tmp', fname)
+		else:
+			counts = np.load(fname, mmap_mode='r+')
+			cells, keep = od_cells(trips, n)
+			np.add.at(counts.reshape(-1), cells[keep], 1)
+			counts.flush()
+			del counts
+		self.last_id = int(trips.id.max())
+		np.save(os.path.join(self.path, 'last_id.npy'), self.last_id)
+		self.counts = np.load(fname, mmap_mode='r')
+		return
+
+	def select(self, start=None, end=None, weekday=None, slot=None,\
+		sub_type=None):
+		# Sub-cube for the given criteria, all values if None:
+		# start, end: station id, city name or a list of station ids
+		# weekday: 0-6 (Monday=0), 'weekday', 'weekend' or a list
+		# slot: 0-95, a list, slice or xrange (see hour_slots)
+		# sub_type: 'Customer', 'Subscriber' or a list of them
+		a = self.counts
+		n = len(self.counts)
+		selectors = [station_selector(start, n), station_selector(end, n),
+		             weekday_selector(weekday), slot_selector(slot),
+		             sub_type_selector(sub_type)]
+		for axis, s in enumerate(selectors):
+			if isinstance(s, slice):
+				a = a[(slice(None),) * axis + (s,)]
+			else:
+				a = a.take(s, axis=axis)
+		return a
+
+	def od_matrix(self, start=None, end=None, **criteria):
+		# Trip counts from each station (rows) to each station (columns)
+		#   over the selected weekdays, slots and sub types, as a full
+		#   stations x stations array (zero outside start and end)
+		n = len(self.counts)
+		m = self.select(start, end, **criteria).sum(axis=(2, 3, 4))
+		rows = np.arange(n)[station_selector(start, n)]
+		columns = np.arange(n)[station_selector(end, n)]
+		full = np.zeros((n, n), dtype=np.int64)
+		full[np.ix_(rows, columns)] = m
+		return full
+
+	def departures(self, **criteria):
+		# Trips starting at each station (indexed by station id)
+		return self.od_matrix(**criteria).sum(axis=1)
+
+	def arrivals(self, **criteria):
+		# Trips ending at each station (indexed by station id)
+		return self.od_matrix(**criteria).sum(axis=0)
+
+	def total(self, **criteria):
+		return int(self.select(**criteria).sum())
+
+	def popular_stations(self, n=5, **criteria):
+		# The n station ids (as strings) with the most trips starting or
+		#   ending there, like popular_stations
+		m = self.od_matrix(**criteria)
+		trips = m.sum(axis=0) + m.sum(axis=1)
+		order = np.argsort(-trips, kind='mergesort')
+		return [str(s) for s in order[:n] if trips[s] > 0]
+
+	def top_routes(self, n=5, **criteria):
+		# The n busiest ('start,end', trips) routes
+		m = self.od_matrix(**criteria)
+		order = np.argsort(-m, axis=None, kind='mergesort')[:n]
+		return [(route_name(i // len(m) * 65536 + i % len(m)), int(m.flat[i]))
+		        for i in order if m.flat[i] > 0]
+
+def od_counts(trip_table, n):
+	# Trip counts of a TripTable as an (n, n, 7, slots, sub types) array,
+	#   from one bincount over the flattened cell numbers
+	cells, keep = od_cells(trip_table, n)
+	shape = (n, n, 7, slots_per_day, len(sub_type_names))
+	counts = np.bincount(cells[keep], minlength=int(np.prod(shape)))
+	return counts.astype(np.int32).reshape(shape)
+
+def od_cells(trip_table, n):
+	# Flat cube cell number of each trip for an n station cube, and a mask
+	#   of the trips whose sub type is in sub_type_names
+	t = trip_table
+	types = np.array([sub_type_names.index(s) if s in sub_type_names else -1
+	                  for s in t.sub_types] + [-1], dtype=np.int64)
+	sub_type = types[t.sub_type] if len(t) else np.zeros(0, dtype=np.int64)
+	keep = sub_type >= 0
+	cells = t.start_station.astype(np.int64) * n + t.end_station
+	cells = cells * 7 + t.weekday
+	cells = cells * slots_per_day + day_slots(t.start_moment)
+	cells = cells * len(sub_type_names) + sub_type
+	return cells, keep
+
+def station_selector(stations, n):
+	# Station axis positions for a station id, city name or list of ids,
+	#   in a cube of n stations
+	if stations is None:
+		return slice(None)
+	if isinstance(stations, basestring) and stations in stations_by_city:
+		stations = stations_by_city[stations]
+	if isinstance(stations, (basestring, int, long, np.integer)):
+		stations = [stations]
+	ids = np.array([int(s) for s in stations], dtype=np.int64)
+	if len(ids) and (ids.min() < 0 or ids.max() >= n):
+		raise ValueError('station ids must be in 0..%d' % (n - 1))
+	return ids
+
+def weekday_selector(weekday):
+	if weekday is None:
+		return slice(None)
+	if weekday == 'weekday':
+		return slice(0, 5)
+	if weekday == 'weekend':
+		return slice(5, 7)
+	if isinstance(weekday, basestring):
+		weekday = weekday_names.index(weekday)
+	return np.array(weekday, dtype=np.int64).reshape(-1)
+
+def slot_selector(slot):
+	if slot is None or isinstance(slot, slice):
+		return slice(None) if slot is None else slot
+	if isinstance(slot, xrange) and slot and slot[-1] - slot[0] + 1 == len(slot):
+		return slice(slot[0], slot[-1] + 1)
+	return np.array(list(slot) if isinstance(slot, xrange) else slot,
+	                dtype=np.int64).reshape(-1)
+
+def sub_type_selector(sub_type):
+	if sub_type is None:
+		return slice(None)
+	if isinstance(sub_type, basestring):
+		sub_type = [sub_type]
+	return np.array([sub_type_names.index(s) for s in sub_type],
+	                dtype=np.int64)
+
+def hour_slots(first, last):
+	# Slots from hour first up to (not including) hour last, e.g. the
+	#   AM peak: cube.total(start='San Francisco', slot=hour_slots(7, 10))
+	per_hour = slots_per_day // 24
+	return xrange(first * per_hour, last * per_hour)
+
+od_cube_path = 'datafiles/od_cube'
+loaded_od_cube = []
+
+def od_cube(trip_data=None, path=od_cube_path):
+	# ODCube saved at path (loaded once per process), built from or
+	#   updated with the TripTable trip_data if given
+	if not loaded_od_cube:
+		if os.path.exists(os.path.join(path, 'counts.npy')):
+			loaded_od_cube.append(ODCube(path))
+		elif trip_data is not None:
+			loaded_od_cube.append(ODCube.build(path, trip_data))
+			return loaded_od_cube[0]
+		else:
+			raise IOError('no OD cube at ' + path)
+	cube = loaded_od_cube[0]
+	if trip_data is not None:
+		cube.add(trip_data)
+	return cube
@@ -0,0 +1,217 @@
+'''
+Snapshot query service: JSON over HTTP from trip and rebalancing data in memory
+
+Loads trips, the TripGraph, the rebalancing index and the OD cube once and
+answers snapshot, station availability and OD queries on worker threads.
+'''
+
+import BaseHTTPServer
+import collections
+import SocketServer
+import threading
+import urllib
+import urllib2
+import urlparse
+from base import *
+from odcube import od_cube, hour_slots
+
+class SnapshotState:
+	# Indexed data shared by all requests, plus an LRU cache of the JSON
+	#   answers for recently requested moments (cache_size entries)
+	def __init__(self, trips=None, index=None, cube=None, cache_size=256):
+		if trips is None:
+			trips = read_data('trip', cache=True)
+		self.trips = trips
+		self.graph = TripGraph(trips)
+		self.graph.intervals() # built now rather than by the first request
+		self.index = rebalancing_index() if index is None else index
+		self.cube = od_cube(trips) if cube is None else cube
+		self.stations = sorted(int(n) for n in self.graph.nodes)
+		self.cache = collections.OrderedDict()
+		self.cache_size = cache_size
+		self.lock = threading.Lock()
+		return
+
+	def cached(self, key, compute):
+		# JSON text for key, from the cache or compute()
+		with self.lock:
+			if key in self.cache:
+				text = self.cache.pop(key)
+				self.cache[key] = text # most recently used
+				return text
+		text = compute()
+		with self.lock:
+			self.cache[key] = text
+			while len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+		return text
+
+	def snapshot(self, moment):
+		# SystemSnapshot at moment, nodes from the in-memory index
+		stations, bikes, freedocks = self.index.snapshot(moment)
+		count = dict(zip(stations.tolist(), bikes.tolist()))
+		nodes = {}
+		for n in self.graph.nodes:
+			b = count.get(int(n), -1)
+			nodes[n] = b if b >= 0 else None
+		edges = self.graph.intervals().active_counts(moment, 'route')
+		return SystemSnapshot(self.graph, moment, nodes, edges)
+
+	def snapshot_json(self, moment):
+		# One SystemSnapshot.frame document, with the stations list
+		def compute():
+			doc = self.snapshot(moment).frame(self.stations)
+			doc['stations'] = np.array(self.stations, dtype=np.int64)
+			return compact_json(doc)
+		return self.cached(('snapshot', moment), compute)
+
+	def stations_json(self, moment):
+		# Bikes and free docks per station at moment (-1: no data)
+		def compute():
+			stations, bikes, freedocks = self.index.snapshot(moment)
+			return compact_json({'moment': moment.isoformat(),
+			                     'stations': stations.astype(np.int64),
+			                     'bikes': bikes.astype(np.int64),
+			                     'freedocks': freedocks.astype(np.int64)})
+		return self.cached(('stations', moment), compute)
+
+	def od_json(self, criteria, n=5):
+		# Total trips, top routes and popular stations from the OD cube
+		def compute():
+			return compact_json({
+				'total': self.cube.total(**criteria),
+				'top_routes': [[r, c] for r, c in
+				               self.cube.top_routes(n, **criteria)],
+				'popular_stations': self.cube.popular_stations(n, **criteria)})
+		key = ('od', n) + tuple(sorted((k, repr(v)) for k, v in
+		                               criteria.items()))
+		return self.cached(key, compute)
+
+def parse_moment(text):
+	# datetime from 'YYYY-MM-DD HH:MM[:SS]' or 'YYYY-MM-DDTHH:MM[:SS]'
+	if not isinstance(text, basestring):
+		raise ValueError('moment must be a string')
+	return np.datetime64(text.strip().replace(' ', 'T'), 's').astype(object)
+
+def od_criteria(params):
+	# ODCube query keywords from request parameters:
+	#   start, end: city name or comma separated station ids
+	#   weekday: 0-6, a day name, 'weekday' or 'weekend'
+	#   hours: 'first-last' hours of day (last excluded), e.g. 7-10
+	#   sub_type: Customer or Subscriber
+	criteria = {}
+	for k in ['start', 'end']:
+		if k in params:
+			v = params[k][0]
+			criteria[k] = v if v in stations_by_city else \
+			              [int(s) for s in v.split(',')]
+	if 'weekday' in params:
+		v = params['weekday'][0]
+		criteria['weekday'] = int(v) if v.isdigit() else v
+	if 'hours' in params:
+		first, last = [int(h) for h in params['hours'][0].split('-')]
+		criteria['slot'] = hour_slots(first, last)
+	if 'sub_type' in params:
+		criteria['sub_type'] = params['sub_type'][0]
+	return criteria
+
+class SnapshotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# GET /snapshot?moment=...   SystemSnapshot frame, repeat moment for a
+	#                            batch ({"snapshots": [...]})
+	# GET /stations?moment=...   availability per station, batches likewise
+	# GET /od?start=...&hours=...  OD cube roll-ups (see od_criteria)
+	# POST /snapshot or /stations with a JSON body {"moments": [...]}
+	#   runs a batch too.
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		self.answer(url.path, urlparse.parse_qs(url.query))
+		return
+
+	def do_POST(self):
+		import simplejson as json
+		url = urlparse.urlparse(self.path)
+		length = int(self.headers.getheader('content-length') or 0)
+		try:
+			body = json.loads(self.rfile.read(length) or '{}')
+		except ValueError:
+			return self.reply(400, compact_json({'error': 'bad JSON body'}))
+		moments = body.get('moments', []) if isinstance(body, dict) else None
+		if not isinstance(moments, list) or \
+		   not all(isinstance(m, basestring) for m in moments):
+			return self.reply(400, compact_json({'error':
+			                  'body must be {"moments": [moment strings]}'}))
+		params = urlparse.parse_qs(url.query)
+		params['moment'] = params.get('moment', []) + moments
+		self.answer(url.path, params)
+		return
+
+	def answer(self, path, params):
+		state = self.server.state
+		moments = params.get('moment', [])
+		try:
+			if path in ('/snapshot', '/stations'):
+				if not moments:
+					raise ValueError('no moment given')
+				query = state.snapshot_json if path == '/snapshot' else \
+				        state.stations_json
+				docs = [query(parse_moment(m)) for m in moments]
+				text = docs[0] if len(docs) == 1 else \
+				       '{"snapshots":[' + ','.join(docs) + ']}'
+			elif path == '/od':
+				n = int(params.get('n', ['5'])[0])
+				text = state.od_json(od_criteria(params), n)
+			else:
+				return self.reply(404, compact_json({'error': 'unknown path'}))
+		except (ValueError, KeyError, IndexError) as e:
+			return self.reply(400, compact_json({'error': str(e)}))
+		return self.reply(200, text)
+
+	def reply(self, status, text):
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(text)))
+		self.end_headers()
+		self.wfile.write(text)
+		return
+
+	def log_message(self, format, *args):
+		return # quiet, requests are logged by the front end
+
+class SnapshotServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	# One thread per request over a shared SnapshotState
+	daemon_threads = True
+	request_queue_size = 256
+
+	def __init__(self, state, address=('127.0.0.1', 8000)):
+		BaseHTTPServer.HTTPServer.__init__(self, address, SnapshotHandler)
+		self.state = state
+		return
+
+def start_service(state=None, host='127.0.0.1', port=0):
+	# Runs a SnapshotServer on a background thread and returns it; port 0
+	#   picks a free port (see server.server_address). Stop it with
+	#   server.shutdown().
+	if state is None:
+		state = SnapshotState()
+	server = SnapshotServer(state, (host, port))
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+def query(address, path, **params):
+	# Client: decoded JSON answer of the service at address (host, port)
+	#   for path, e.g. query(server.server_address, '/snapshot',
+	#   moment=['2013-09-03 08:00', '2013-09-03 08:15'])
+	import simplejson as json
+	url = 'http://%s:%d%s' % (address[0], address[1], path)
+	if params:
+		url += '?' + urllib.urlencode(params, doseq=True)
+	return json.loads(urllib2.urlopen(url).read())
+
+if __name__ == '__main__':
+	import sys
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+	server = SnapshotServer(SnapshotState(), ('127.0.0.1', port))
+	print "serving on port", port
+	server.serve_forever()
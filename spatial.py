@@ -0,0 +1,141 @@
+'''
+Spatial index over station locations
+
+Stations are projected to meters on one system-wide plane (from
+center_latlon and latlon_scale) and bucketed in a uniform grid for nearest
+neighbor and radius queries.
+'''
+
+from base import *
+
+# system-wide projection: mean city center and meters per degree lat, lon
+projection_center = np.mean(center_latlon.values(), axis=0)
+projection_scale = np.mean(latlon_scale.values(), axis=0)
+
+def project(lat, lon):
+	# (x, y) meters east and north of projection_center for scalars or arrays
+	x = (np.asarray(lon, dtype=np.float64) - projection_center[1]) \
+	    * projection_scale[1]
+	y = (np.asarray(lat, dtype=np.float64) - projection_center[0]) \
+	    * projection_scale[0]
+	return x, y
+
+class StationIndex:
+	# Grid index over a list of Stations. Each station's projected point
+	#   falls in a square cell of cell_size meters; cells maps a cell to
+	#   the positions of its stations. Searches visit rings of cells
+	#   around the query point and switch to a scan of all stations once
+	#   a ring would cover more cells than are occupied.
+	def __init__(self, station_data, cell_size=250.0):
+		self.cell_size = float(cell_size)
+		self.ids = np.array([int(s.id) for s in station_data], dtype=np.int64)
+		self.x, self.y = project([s.lat for s in station_data],
+		                         [s.lon for s in station_data])
+		self.elevation = np.array([s.elevation for s in station_data])
+		n = int(self.ids.max()) + 1 if len(self.ids) else 0
+		self.position = np.zeros(n, dtype=np.int64) - 1 # by station id
+		self.position[self.ids] = np.arange(len(self.ids))
+		self.cells = {}
+		cx, cy = self.cell(self.x, self.y)
+		for i in xrange(len(self.ids)):
+			self.cells.setdefault((int(cx[i]), int(cy[i])), []).append(i)
+		return
+
+	def cell(self, x, y):
+		return np.floor(x / self.cell_size), np.floor(y / self.cell_size)
+
+	def candidates(self, x, y, rings, mask=None):
+		# Positions of the stations in cells up to rings away from (x, y),
+		#   None if that covers more cells than are occupied (scan all)
+		if (2 * rings + 1) ** 2 > len(self.cells):
+			return None
+		cx, cy = [int(c) for c in self.cell(x, y)]
+		found = []
+		for i in xrange(cx - rings, cx + rings + 1):
+			for j in xrange(cy - rings, cy + rings + 1):
+				found += self.cells.get((i, j), [])
+		found = np.array(found, dtype=np.int64)
+		return found if mask is None else found[mask[found]]
+
+	def ranked(self, x, y, positions, k):
+		# (station id strings, meters) of the k positions closest to (x, y)
+		d = np.hypot(self.x[positions] - x, self.y[positions] - y)
+		order = np.argsort(d, kind='mergesort')[:k]
+		return [(str(self.ids[positions[i]]), float(d[i])) for i in order]
+
+	def nearest(self, lat, lon, k=1, mask=None):
+		# The k stations closest to (lat, lon) as (station id, meters)
+		#   pairs, closest first
+		# mask: boolean array by position (see ids), only True are returned
+		x, y = project(lat, lon)
+		everything = np.arange(len(self.ids)) if mask is None else \
+		             np.flatnonzero(mask)
+		rings = 0
+		while True:
+			found = self.candidates(x, y, rings, mask)
+			if found is None:
+				return self.ranked(x, y, everything, k)
+			if len(found) >= min(k, len(everything)):
+				best = self.ranked(x, y, found, k)
+				# anything outside the rings is at least rings cells away
+				if not best or best[-1][1] <= rings * self.cell_size:
+					return best
+			rings += 1
+
+	def within(self, lat, lon, radius, mask=None):
+		# Stations within radius meters of (lat, lon), closest first
+		x, y = project(lat, lon)
+		rings = int(np.ceil(radius / self.cell_size))
+		found = self.candidates(x, y, rings, mask)
+		if found is None:
+			found = np.arange(len(self.ids)) if mask is None else \
+			        np.flatnonzero(mask)
+		found = found[np.hypot(self.x[found] - x, self.y[found] - y) <= radius]
+		return self.ranked(x, y, found, len(found))
+
+	def nearest_with_bikes(self, lat, lon, moment, k=1, min_bikes=1,\
+		index=None):
+		# The k stations closest to (lat, lon) with at least min_bikes
+		#   bikes at moment (per the rebalancing data), as (station id,
+		#   meters, bikes) tuples
+		if index is None:
+			index = rebalancing_index()
+		stations, bikes, freedocks = index.snapshot(moment)
+		count = np.zeros(len(self.position), dtype=np.int64) - 1
+		known = stations < len(count)
+		count[stations[known]] = bikes[known]
+		available = count[self.ids] >= min_bikes
+		return [(s, d, int(count[int(s)]))
+		        for s, d in self.nearest(lat, lon, k, available)]
+
+	def positions_of(self, stations):
+		# Positions of an array of station ids (-1 for unknown stations)
+		stations = np.asarray(stations, dtype=np.int64)
+		p = np.zeros(stations.shape, dtype=np.int64) - 1
+		known = (stations >= 0) & (stations < len(self.position))
+		p[known] = self.position[stations[known]]
+		return p
+
+	def route_features(self, start_stations, end_stations):
+		# Straight-line distance (meters) and end minus start elevation per
+		#   route for arrays of station ids (nan where a station is unknown),
+		#   e.g. index.route_features(trips.start_station, trips.end_station)
+		s = self.positions_of(start_stations)
+		e = self.positions_of(end_stations)
+		distance = np.hypot(self.x[e] - self.x[s], self.y[e] - self.y[s])
+		elevation = self.elevation[e] - self.elevation[s]
+		unknown = (s < 0) | (e < 0)
+		distance[unknown] = np.nan
+		elevation[unknown] = np.nan
+		return distance, elevation
+
+loaded_station_index = []
+
+def station_index(station_data=None):
+	# StationIndex over station_data (read from the station file if None),
+	#   built once per process
+	if not loaded_station_index:
+		if station_data is None:
+			station_data = read_data('station', cache=True)
+		loaded_station_index.append(StationIndex(station_data))
+	return loaded_station_index[0]
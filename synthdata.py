@@ -0,0 +1,122 @@
+'''
+Deterministic synthetic bikeshare data for benchmarks
+
+Writes trip, station and raw rebalancing csv files (plus station_dict.txt)
+in the formats Trip, Station and Rebalancing parse, at any scale.
+'''
+
+import datetime as dt
+import os
+import numpy as np
+from constants import stations_by_city, center_latlon, latlon_scale
+
+first_day = np.datetime64('2013-08-29')
+
+def generate(path, trips=144000, days=183, rebalancing_days=7, seed=0):
+	# Writes path/datafiles/{201402_trip_data, station_data,
+	#   201402_rebalancing_data}.csv and station_dict.txt. The same
+	#   arguments always produce the same files. Returns line counts.
+	rs = np.random.RandomState(seed)
+	datadir = os.path.join(path, 'datafiles')
+	if not os.path.isdir(datadir):
+		os.makedirs(datadir)
+	stations = write_stations(datadir, rs)
+	counts = {'station': len(stations)}
+	counts['trip'] = write_trips(datadir, rs, stations, trips, days)
+	counts['rebalancing'] = write_rebalancing(datadir, rs, stations,
+	                                          rebalancing_days)
+	return counts
+
+def write_stations(datadir, rs):
+	# One station per id in stations_by_city; returns [(id, city, docks)]
+	stations = []
+	names = {}
+	lines = ['station_id,name,lat,long,dockcount,landmark,installation,elevation\n']
+	for city in sorted(stations_by_city):
+		for s in sorted(stations_by_city[city], key=int):
+			lat, lon = center_latlon[city]
+			lat += rs.normal(0, 800) / latlon_scale[city][0]
+			lon += rs.normal(0, 800) / latlon_scale[city][1]
+			docks = int(rs.choice([11, 15, 19, 23, 27]))
+			name = 'Station ' + s
+			names[name] = s
+			lines.append('%s,%s,%.6f,%.6f,%d,%s,8/%d/2013,%.1f\n' % (s, name,
+			             lat, lon, docks, city, rs.randint(5, 24),
+			             rs.uniform(0, 60)))
+			stations.append((s, city, docks))
+	with open(os.path.join(datadir, 'station_data.csv'), 'w') as f:
+		f.write(''.join(lines))
+	with open(os.path.join(datadir, 'station_dict.txt'), 'w') as f:
+		f.write('{' + ', '.join('"%s": "%s"' % (k, names[k])
+		                         for k in sorted(names)) + '}')
+	return stations
+
+def minute_strings(minutes):
+	# "m/d/yyyy h:mm" for an array of datetime64[m], each distinct minute
+	#   formatted once
+	out = {}
+	for m in np.unique(minutes):
+		d = m.astype(dt.datetime)
+		out[m] = '%d/%d/%d %d:%02d' % (d.month, d.day, d.year, d.hour, d.minute)
+	return [out[m] for m in minutes]
+
+def write_trips(datadir, rs, stations, n, days, chunk=500000):
+	# n trips with morning/evening peaks, mostly within one city
+	ids = np.array([int(s[0]) for s in stations])
+	cities = np.array([s[1] for s in stations])
+	weight = 1.0 / np.arange(1, len(ids) + 1) ** .7 # some stations busier
+	weight = rs.permutation(weight / weight.sum())
+	header = 'Trip ID,Duration,Start Date,Start Station,Start Terminal,'\
+	         'End Date,End Station,End Terminal,Bike #,Subscription Type,'\
+	         'Zip Code\n'
+	with open(os.path.join(datadir, '201402_trip_data.csv'), 'w') as f:
+		f.write(header)
+		for lo in range(0, n, chunk):
+			m = min(chunk, n - lo)
+			start = rs.choice(len(ids), m, p=weight)
+			end = start.copy()
+			for c in np.unique(cities):
+				same = np.flatnonzero(cities[start] == c)
+				options = np.flatnonzero(cities == c)
+				end[same] = options[rs.randint(0, len(options), len(same))]
+			day = rs.randint(0, days, m)
+			hour = np.where(rs.rand(m) < .6,
+			                rs.choice([8, 17], m) + rs.normal(0, 1.2, m),
+			                rs.uniform(6, 23, m)).clip(0, 23.99)
+			t0 = first_day + day.astype('timedelta64[D]') \
+			     + (hour * 60).astype('timedelta64[m]')
+			duration = rs.lognormal(6.3, .6, m).astype(np.int64) + 60
+			t1 = t0 + (duration // 60).astype('timedelta64[m]')
+			s0, s1 = minute_strings(t0), minute_strings(t1)
+			bikes = rs.randint(1, 700, m)
+			sub = np.where(rs.rand(m) < .85, 'Subscriber', 'Customer')
+			zips = rs.randint(94002, 95200, m)
+			lines = []
+			for i in xrange(m):
+				a, b = ids[start[i]], ids[end[i]]
+				lines.append('%d,%d,%s,Station %d,%d,%s,Station %d,%d,%d,%s,%d\n'
+				             % (4000 + lo + i, duration[i], s0[i], a, a, s1[i],
+				                b, b, bikes[i], sub[i], zips[i]))
+			f.write(''.join(lines))
+	return n
+
+def write_rebalancing(datadir, rs, stations, days):
+	# One reading per station per minute, ordered by station then time
+	#   like the raw feed, with the time field quoted
+	minutes = days * 24 * 60
+	times = first_day + np.arange(minutes).astype('timedelta64[m]')
+	stamps = [t.astype(dt.datetime).strftime('"%Y/%m/%d %H:%M:%S"')
+	          for t in times + np.timedelta64(1, 's')]
+	with open(os.path.join(datadir, '201402_rebalancing_data.csv'), 'w') as f:
+		f.write('station_id,bikes_available,docks_available,time\n')
+		for s, city, docks in stations:
+			change = rs.choice([-1, 0, 0, 0, 0, 0, 0, 0, 1], minutes)
+			bikes = (docks // 2 + np.cumsum(change)) % (docks + 1)
+			f.write(''.join(['%s,%d,%d,%s\n' % (s, bikes[i], docks - bikes[i],
+			                 stamps[i]) for i in xrange(minutes)]))
+	return minutes * len(stations)
+
+if __name__ == "__main__":
+	import sys
+	n = int(sys.argv[2]) if len(sys.argv) > 2 else 144000
+	print generate(sys.argv[1] if len(sys.argv) > 1 else '.', n)
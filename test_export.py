@@ -0,0 +1,74 @@
+'''
+Tests for the JSON series export
+
+Run with "python -m unittest test_export". Snapshots are built from
+given nodes and edges, so no data files are needed.
+'''
+
+import datetime as dt
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import simplejson as json
+from export import *
+
+def series(frames, stations=70, changing=0.8, seed=0):
+	# SystemSnapshots 15 minutes apart where about the changing fraction
+	#   of stations has a new bike count from one frame to the next
+	rng = random.Random(seed)
+	ids = [str(s) for s in range(2, 2 + stations)]
+	bikes = dict((s, rng.randint(0, 15)) for s in ids)
+	start = dt.datetime(2013, 9, 2)
+	snapshots = []
+	for i in range(frames):
+		for s in ids:
+			if rng.random() < changing:
+				bikes[s] = rng.randint(0, 15)
+		edges = {}
+		for k in range(rng.randint(0, 20)):
+			e = rng.choice(ids) + ',' + rng.choice(ids)
+			edges[e] = edges.get(e, 0) + 1
+		moment = start + dt.timedelta(minutes=15 * i)
+		snapshots.append(SystemSnapshot(None, moment, dict(bikes), edges))
+	return snapshots
+
+class ExportJsonSeriesTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def size(self, snapshots, **kwargs):
+		fname = os.path.join(self.dir, 'series.json')
+		export_json_series(snapshots, fname, **kwargs)
+		return os.path.getsize(fname)
+
+	def test_default_no_larger_than_full_frames(self):
+		for changing in [0.05, 0.5, 0.8, 1.0]:
+			snapshots = series(96, changing=changing)
+			self.assertLessEqual(self.size(snapshots),
+			                     self.size(snapshots, delta=False))
+
+	def test_delta_frames_rebuild_the_full_frames(self):
+		snapshots = series(20, changing=0.05)
+		fname = os.path.join(self.dir, 'series.json')
+		export_json_series(snapshots, fname)
+		with open(fname) as f:
+			doc = json.load(f)
+		stations = doc['stations']
+		bikes = None
+		for snapshot, frame in zip(snapshots, doc['frames']):
+			if frame.get('delta'):
+				pairs = frame['bikes']
+				for i in range(0, len(pairs), 2):
+					bikes[pairs[i]] = pairs[i + 1]
+			else:
+				bikes = list(frame['bikes'])
+			expected = snapshot.frame(stations)['bikes'].tolist()
+			self.assertEqual(bikes, expected)
+
+if __name__ == '__main__':
+	unittest.main()